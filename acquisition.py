@@ -0,0 +1,110 @@
+import threading
+import time
+
+from enum import Enum
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LatePolicy(Enum):
+    # What to do with frame deadlines that passed while a read was running
+    CATCHUP = "catchup"  # run them back to back until on schedule again
+    SKIP = "skip"  # drop them and read at the most recent one
+
+
+class Acquisition:
+    # Calls read_frame(deadline) on its own thread at absolute
+    # time.monotonic() deadlines spaced `period` seconds apart, so the frame
+    # rate does not drift with the read time or other work
+    def __init__(
+        self,
+        period: float,
+        read_frame,
+        late_policy: LatePolicy = LatePolicy.SKIP,
+        stats_interval: float = 10,
+        name: str = "acquisition",
+    ) -> None:
+        self.period = period
+        self.read_frame = read_frame
+        self.late_policy = late_policy
+        self.stats_interval = stats_interval
+        self.stop_flag = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+        self.lock = threading.Lock()
+        self.start_time = None
+        # Set by stop(), so the average rate covers only the time acquiring
+        self.stop_time = None
+        self.frames = 0
+        self.deadline_misses = 0
+        self.skipped_frames = 0
+        self.max_lateness = 0.0
+        self.frame_rate = 0.0
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        with self.lock:
+            if self.start_time is not None and self.stop_time is None:
+                self.stop_time = time.monotonic()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    def get_stats(self):
+        with self.lock:
+            end_time = self.stop_time if self.stop_time is not None else time.monotonic()
+            elapsed = end_time - self.start_time if self.start_time is not None else 0
+            return {
+                "frames": self.frames,
+                "frame_rate": self.frame_rate,
+                "average_frame_rate": self.frames / elapsed if elapsed else 0.0,
+                "target_frame_rate": 1 / self.period,
+                "deadline_misses": self.deadline_misses,
+                "skipped_frames": self.skipped_frames,
+                "max_lateness_ms": self.max_lateness * 1000,
+            }
+
+    def run(self):
+        deadline = time.monotonic()
+        with self.lock:
+            self.start_time = deadline
+        stats_time = deadline
+        stats_frames = 0
+        while not self.stop_flag.is_set():
+            now = time.monotonic()
+            if now < deadline:
+                self.stop_flag.wait(deadline - now)
+                continue
+
+            lateness = now - deadline
+            with self.lock:
+                self.max_lateness = max(self.max_lateness, lateness)
+                if lateness >= self.period:
+                    self.deadline_misses += 1
+                    if self.late_policy == LatePolicy.SKIP:
+                        # Move to the most recent deadline that already passed
+                        skipped = int(lateness // self.period)
+                        self.skipped_frames += skipped
+                        deadline += skipped * self.period
+
+            try:
+                self.read_frame(deadline)
+            except Exception as e:
+                logger.error(f"Error: Failed to acquire frame: {e}")
+            deadline += self.period
+
+            with self.lock:
+                self.frames += 1
+            stats_frames += 1
+            if now - stats_time >= self.stats_interval:
+                with self.lock:
+                    self.frame_rate = stats_frames / (now - stats_time)
+                stats_time = now
+                stats_frames = 0
+                logger.info(f"Acquisition stats: {self.get_stats()}")
@@ -1,48 +1,78 @@
+import time
+
+# Startup is timed from here, before the imports
+STARTUP_TIME = time.perf_counter()
+
 import tkinter as tk
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from connect import scan_ports_and_connect, connect_port
+from concurrent.futures import ThreadPoolExecutor
+from connect import connect_device
 from indicator import Indicator
 from data_api import write_modbus
 from config import ConfigSingleton
 from custom_data import CustomData, DataMode
-from frame_chart import TimeChart, FFTChart
 from scheduler import Scheduler
+from bus import Bus, TransactionClass
+from publisher import start_publisher
+from instrumentation import instrumentation
+from logging_setup import setup_logging
+from dsp_worker import dsp_worker
 import customtkinter
 import logging
 
-logging.basicConfig(
-    level=logging.INFO,  # Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",  # Set the log message format
-    handlers=[
-        logging.FileHandler("app.log"),  # Log to a file
-        logging.StreamHandler(),  # Log to the console
-    ],
-)
+# Records are written to app.log and the console by a background thread
+logging_setup = setup_logging()
 
 logger = logging.getLogger(__name__)
 
 CLIENT = None
+BUS = None
+# Seconds from STARTUP_TIME to each startup stage
+STARTUP_TIMES = {}
+
+
+def mark_startup(stage: str):
+    STARTUP_TIMES[stage] = time.perf_counter() - STARTUP_TIME
+    instrumentation.record(f"startup.{stage}", STARTUP_TIME)
 
 
 def close(
     indicator: Indicator,
     custom_data: CustomData,
-    time_chart: TimeChart,
-    fft_chart: FFTChart,
+    charts,
     scheduler: Scheduler,
+    bus: Bus,
+    emulator=None,
+    executor: ThreadPoolExecutor = None,
 ):
+    # indicator, custom_data, bus and emulator are None, and charts empty,
+    # when closing before they were created
     logger.info("Closing App...")
-    custom_data.stop()
-    logger.info("Chart data refresh stopped")
-    time_chart.stop()
-    logger.info("Time chart closed")
-    fft_chart.stop()
-    logger.info("FFT chart closed")
-    indicator.stop()
-    logger.info("Indicator refresh stopped")
+    if executor is not None:
+        # Doesn't wait for a chart import or connection still in progress
+        executor.shutdown(wait=False)
+    if custom_data is not None:
+        custom_data.stop()
+        logger.info(f"Chart data refresh stopped: {custom_data.get_stats()}")
+        if custom_data.publisher is not None:
+            custom_data.publisher.stop()
+            logger.info("Frame publisher stopped")
+    for chart in charts:
+        chart.stop()
+        logger.info(f"{type(chart).__name__} closed")
+    dsp_worker.stop()
+    logger.info(f"DSP worker stopped: {dsp_worker.get_stats()}")
+    if indicator is not None:
+        indicator.stop()
+        logger.info("Indicator refresh stopped")
     scheduler.stop()
     logger.info("Scheduler stopped")
+    if bus is not None:
+        bus.stop()
+        logger.info(f"Bus stopped: {bus.get_stats()}")
+    if emulator is not None:
+        emulator.stop()
+        logger.info("Device emulator stopped")
+    logger.info(f"Logging: {logging_setup.get_stats()}")
 
 
 START_DEVICE_WRITE_ADDRESS = ConfigSingleton().get_config()[
@@ -59,26 +89,39 @@ LOCK_LASER_WRITE_VALUE = ConfigSingleton().get_config()["LOCK_LASER_WRITE_VALUE"
 DDS_WRITE_ADDRESS = ConfigSingleton().get_config()["DDS_WRITE_ADDRESS"]
 DDS_WRITE_VALUE = ConfigSingleton().get_config()["DDS_WRITE_VALUE"]
 DEVICE_PORT = ConfigSingleton().get_config()["DEVICE_PORT"]
+TIME_CHART_RANGES = ConfigSingleton().get_config()["TIME_CHART_RANGES"]
+
+
+def format_time_range(seconds):
+    if seconds >= 3600 and seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds >= 60 and seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+def submit_write(address, value):
+    # Queued on the bus thread so the button never blocks the UI
+    global BUS
+    BUS.submit(
+        lambda client: write_modbus(client, address, value), TransactionClass.WRITE
+    )
 
 
 def start_device():
-    global CLIENT
-    write_modbus(CLIENT, START_DEVICE_WRITE_ADDRESS, START_DEVICE_WRITE_VALUE)
+    submit_write(START_DEVICE_WRITE_ADDRESS, START_DEVICE_WRITE_VALUE)
 
 
 def increase_temp():
-    global CLIENT
-    write_modbus(CLIENT, INCREASE_TEMP_WRITE_ADDRESS, INCREASE_TEMP_WRITE_VALUE)
+    submit_write(INCREASE_TEMP_WRITE_ADDRESS, INCREASE_TEMP_WRITE_VALUE)
 
 
 def lock_laser():
-    global CLIENT
-    write_modbus(CLIENT, LOCK_LASER_WRITE_ADDRESS, LOCK_LASER_WRITE_VALUE)
+    submit_write(LOCK_LASER_WRITE_ADDRESS, LOCK_LASER_WRITE_VALUE)
 
 
 def start_dds():
-    global CLIENT
-    write_modbus(CLIENT, DDS_WRITE_ADDRESS, DDS_WRITE_VALUE)
+    submit_write(DDS_WRITE_ADDRESS, DDS_WRITE_VALUE)
 
 
 def read_sin(custom_data: CustomData):
@@ -89,22 +132,61 @@ def read_dds(custom_data: CustomData):
     custom_data.set_mode(DataMode.DDS)
 
 
+def read_both(custom_data: CustomData):
+    custom_data.set_mode(DataMode.BOTH)
+
+
+def show_stats(root):
+    # Pipeline timings and throughput, refreshed every second while open
+    window = customtkinter.CTkToplevel(root)
+    window.title("统计")
+    window.geometry("720x480")
+    textbox = customtkinter.CTkTextbox(window, font=("Courier", 13), wrap="none")
+    textbox.pack(fill="both", expand=True, padx=5, pady=5)
+    dump_button = customtkinter.CTkButton(
+        window, text="保存到文件", command=lambda: instrumentation.dump()
+    )
+    dump_button.pack(padx=5, pady=5)
+
+    def refresh():
+        if not window.winfo_exists():
+            return
+        textbox.delete("1.0", "end")
+        textbox.insert("1.0", instrumentation.format())
+        window.after(1000, refresh)
+
+    refresh()
+
+
+def import_charts():
+    # A literal import, so PyInstaller bundles frame_chart and what it
+    # imports (matplotlib, scipy)
+    import frame_chart
+
+    return frame_chart
+
+
 def main():
     global CLIENT
-    if DEVICE_PORT:
-        CLIENT = connect_port(DEVICE_PORT)
-        assert CLIENT is not None, f"Can't connect to port {DEVICE_PORT}"
-    else:
-        clients = scan_ports_and_connect()
-        assert len(clients) == 1, "Can't find proper port to connect"
-        CLIENT = clients[0]
+    global BUS
+    mark_startup("imports")
+    # matplotlib and the scipy FFT stack are most of the startup time, they
+    # are imported in the background while the window comes up and the
+    # device is connected on a second thread
+    executor = ThreadPoolExecutor(max_workers=2)
+    chart_module = executor.submit(import_charts)
+    connection = executor.submit(connect_device, DEVICE_PORT)
+    connect_error = None
+    indicator = None
+    custom_data = None
+    emulator = None
+    charts = []
+    scheduler = Scheduler()
 
     try:
         root = customtkinter.CTk()
         root.geometry("1920x1080")  # Set the size of the window
 
-        scheduler = Scheduler()
-
         # Create two frames for the sections
         left_frame = customtkinter.CTkFrame(root)
         right_frame = customtkinter.CTkFrame(root)
@@ -152,15 +234,6 @@ def main():
         )
         radio_label.place(in_=radio_frame, anchor="c", relx=0.5, rely=0.5)
 
-        indicator = Indicator(
-            CLIENT,
-            scheduler.get_scheduler(),
-            root,
-            temp_label,
-            laser_label,
-            radio_label,
-        )
-
         buttons_frame.grid_columnconfigure(0, weight=1)
         buttons_frame.grid_rowconfigure(0, weight=1)
         buttons_frame.grid_rowconfigure(1, weight=1)
@@ -218,7 +291,40 @@ def main():
         )
         read_sin_DDS.pack(padx=5, pady=5)
 
-        custom_data = CustomData(CLIENT, scheduler.get_scheduler())
+        read_both_button = customtkinter.CTkButton(
+            read_button_frame,
+            text="同时读取",
+            width=40,
+            height=6,
+            command=lambda: read_both(custom_data),
+        )
+        read_both_button.pack(padx=5, pady=5)
+
+        # Channel shown while both are read
+        display_mode_button = customtkinter.CTkSegmentedButton(
+            read_button_frame,
+            values=[DataMode.SIN.name, DataMode.DDS.name],
+            command=lambda value: custom_data.set_display_mode(DataMode[value]),
+        )
+        display_mode_button.pack(padx=5, pady=5)
+
+        # Time chart span, longer ones are drawn from the downsampled history
+        time_ranges = {
+            format_time_range(seconds): seconds for seconds in TIME_CHART_RANGES
+        }
+
+        def set_time_range(value):
+            # The time chart is charts[0] once the charts are loaded
+            if charts:
+                charts[0].set_time_range(time_ranges[value])
+
+        time_range_button = customtkinter.CTkSegmentedButton(
+            read_button_frame,
+            values=list(time_ranges),
+            command=set_time_range,
+        )
+        time_range_button.set(next(iter(time_ranges)))
+        time_range_button.pack(padx=5, pady=5)
 
         download_on = customtkinter.StringVar(value="off")
         download_switch = customtkinter.CTkSwitch(
@@ -233,6 +339,15 @@ def main():
         )
         download_switch.pack(padx=5, pady=5, fill="x")
 
+        stats_button = customtkinter.CTkButton(
+            read_button_frame,
+            text="统计",
+            width=40,
+            height=6,
+            command=lambda: show_stats(root),
+        )
+        stats_button.pack(padx=5, pady=5)
+
         chart_download_frame = customtkinter.CTkFrame(right_frame)
         chart_download_frame.pack(fill="both", side=tk.RIGHT, expand=True)
 
@@ -244,31 +359,112 @@ def main():
         time_chart_frame = customtkinter.CTkFrame(chart_download_frame)
         time_chart_frame.pack(side=tk.TOP, fill="both", expand=True)
 
-        time_chart = TimeChart(
-            custom_data,
-            time_chart_frame,
-            lowpass_cutoff_entry,
-            highpass_cutoff_entry,
-        )
-
         fft_chart_frame = customtkinter.CTkFrame(chart_download_frame)
         fft_chart_frame.pack(side=tk.TOP, fill="both", expand=True)
 
-        fft_chart = FFTChart(
-            custom_data,
-            fft_chart_frame,
-        )
+        spectrogram_chart_frame = customtkinter.CTkFrame(chart_download_frame)
+        spectrogram_chart_frame.pack(side=tk.TOP, fill="both", expand=True)
+
+        # Everything that talks to the device stays disabled until the bus
+        # and custom_data exist
+        device_widgets = [
+            start_button,
+            temp_button,
+            lock_laser_button,
+            start_dds_button,
+            read_sin_button,
+            read_sin_DDS,
+            read_both_button,
+            display_mode_button,
+            download_switch,
+        ]
+        for widget in device_widgets:
+            widget.configure(state="disabled")
+
+        # Show the window while connecting, port probing can take a while
+        root.update()
+        mark_startup("window")
+
+        def connected():
+            # Polled from the Tk loop until connect_device returns, the bus,
+            # indicator and custom_data are then created on this thread
+            global CLIENT
+            global BUS
+            nonlocal indicator, custom_data, emulator, connect_error
+            if not connection.done():
+                root.after(50, connected)
+                return
+            try:
+                CLIENT, emulator = connection.result()
+            except Exception as e:
+                # Raised from main() once the Tk loop stops
+                connect_error = e
+                root.quit()
+                return
+            BUS = Bus(CLIENT)
+            indicator = Indicator(
+                BUS,
+                scheduler.get_scheduler(),
+                root,
+                temp_label,
+                laser_label,
+                radio_label,
+            )
+            custom_data = CustomData(BUS, publisher=start_publisher())
+            for widget in device_widgets:
+                widget.configure(state="normal")
+            mark_startup("connect")
+            create_charts()
+
+        def create_charts():
+            # Polled from the Tk loop until the chart modules are imported,
+            # the charts themselves have to be created on this thread
+            if not chart_module.done():
+                root.after(50, create_charts)
+                return
+            try:
+                frame_chart = chart_module.result()
+            except Exception as e:
+                logger.error(f"Charts unavailable: {e}")
+                return
+            time_chart = frame_chart.TimeChart(
+                custom_data,
+                time_chart_frame,
+                lowpass_cutoff_entry,
+                highpass_cutoff_entry,
+            )
+            time_chart.set_time_range(time_ranges[time_range_button.get()])
+            charts.append(time_chart)
+            charts.append(frame_chart.FFTChart(custom_data, fft_chart_frame))
+            charts.append(
+                frame_chart.SpectrogramChart(custom_data, spectrogram_chart_frame)
+            )
+            mark_startup("charts")
+            logger.info(
+                "Startup: "
+                + ", ".join(
+                    f"{stage} {seconds:.2f} s"
+                    for stage, seconds in STARTUP_TIMES.items()
+                )
+            )
+
+        root.after(0, connected)
 
         def on_closing():
-            close(indicator, custom_data, time_chart, fft_chart, scheduler)
+            close(indicator, custom_data, charts, scheduler, BUS, emulator, executor)
             root.destroy()
             root.quit()
 
         root.protocol("WM_DELETE_WINDOW", on_closing)
 
         root.mainloop()
+        if connect_error is not None:
+            raise connect_error
     except:
-        close(indicator, custom_data, time_chart, fft_chart, scheduler)
+        # Includes failing to connect, which happens after the window is shown
+        logger.exception("App stopped on an error")
+        close(indicator, custom_data, charts, scheduler, BUS, emulator, executor)
+        raise
 
 
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+import asyncio
+import struct
+import sys
+import time
+import serial
+from pymodbus.utilities import checkCRC, computeCRC
+import data_api
+from config import ConfigSingleton
+from data_api import DataType
+from bus import rtu_frame_gap
+from instrumentation import instrumentation
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SLAVE_ID = ConfigSingleton().get_config()["SLAVE_ID"]
+BAUDRATE = ConfigSingleton().get_config()["BAUDRATE"]
+ASYNC_REQUEST_TIMEOUT = ConfigSingleton().get_config()["ASYNC_REQUEST_TIMEOUT"]
+
+# How often the port is polled where the event loop can't watch it
+# (Windows, ports without a file descriptor)
+POLL_INTERVAL = 0.002
+
+READ_HOLDING_REGISTERS = 3
+WRITE_SINGLE_REGISTER = 6
+
+
+class ModbusError(Exception):
+    pass
+
+
+def modbus_request(slave_id: int, function_code: int, address: int, value: int):
+    request = struct.pack(">BBHH", slave_id, function_code, address, value)
+    return request + struct.pack(">H", computeCRC(request))
+
+
+class AsyncTransport:
+    # Asyncio counterpart of the Bus: owns one serial port and runs the custom
+    # frame protocol and Modbus RTU requests on it one at a time, with the RTU
+    # inter-frame gap between them. Every request is awaitable, has its own
+    # timeout and can be cancelled, a cancelled request's late reply is
+    # discarded before the next one.
+    def __init__(
+        self,
+        port_name: str,
+        baudrate: int = BAUDRATE,
+        timeout: float = ASYNC_REQUEST_TIMEOUT,
+        slave_id: int = SLAVE_ID,
+    ) -> None:
+        self.port_name = port_name
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.slave_id = slave_id
+        self.frame_gap = rtu_frame_gap(baudrate)
+        self.serial = None
+        self.loop = None
+        self.lock = None
+        self.buffer = bytearray()
+        self.readable = None
+        self.watching = False
+        self.last_end = 0.0
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        self.readable = asyncio.Event()
+        # timeout=0 makes reads return whatever is already received
+        self.serial = serial.Serial(
+            port=self.port_name, baudrate=self.baudrate, timeout=0
+        )
+        try:
+            self.loop.add_reader(self.serial.fileno(), self.on_readable)
+            self.watching = True
+        except (NotImplementedError, AttributeError, ValueError):
+            # The proactor loop on Windows can't watch a serial handle
+            logger.info(f"Polling {self.port_name} every {POLL_INTERVAL * 1000} ms")
+            self.watching = False
+        return self
+
+    async def close(self):
+        if self.serial is None:
+            return
+        if self.watching:
+            self.loop.remove_reader(self.serial.fileno())
+            self.watching = False
+        self.serial.close()
+        self.serial = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def on_readable(self):
+        try:
+            self.buffer.extend(self.serial.read(self.serial.in_waiting or 1))
+        except (OSError, serial.SerialException) as e:
+            logger.error(f"Error reading {self.port_name}: {e}")
+            self.loop.remove_reader(self.serial.fileno())
+            self.watching = False
+        self.readable.set()
+
+    async def read_exactly(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if self.watching:
+                self.readable.clear()
+                await self.readable.wait()
+            else:
+                data = self.serial.read(self.serial.in_waiting)
+                if data:
+                    self.buffer.extend(data)
+                else:
+                    await asyncio.sleep(POLL_INTERVAL)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def request(self, request: bytes, read_reply, timeout: float = None):
+        # Sends request and returns await read_reply(), raises
+        # asyncio.TimeoutError after timeout seconds
+        if self.serial is None:
+            raise serial.SerialException(f"{self.port_name} is not open")
+        async with self.lock:
+            gap = self.last_end + self.frame_gap - time.monotonic()
+            if gap > 0:
+                await asyncio.sleep(gap)
+            # Drop anything left over from a cancelled or timed out request
+            self.serial.reset_input_buffer()
+            self.buffer.clear()
+            try:
+                self.serial.write(request)
+                return await asyncio.wait_for(
+                    read_reply(), self.timeout if timeout is None else timeout
+                )
+            finally:
+                self.last_end = time.monotonic()
+
+    async def read_custom_data(
+        self, command: str, data_type: DataType, timeout: float = None
+    ):
+        # Same result as data_api.read_custom_data: the decoded samples or
+        # None, failures are logged
+        if data_api.FAKE_CUSTOM_DATA:
+            return data_api.get_fake_data()
+        try:
+            start = instrumentation.now()
+            byte_array = await self.request(
+                bytes.fromhex(command),
+                lambda: self.read_exactly(data_api.custom_frame_length()),
+                timeout,
+            )
+            instrumentation.record("serial_round_trip", start)
+            instrumentation.count("bytes", len(byte_array))
+            start = instrumentation.now()
+            data = data_api.parse_custom_frame(byte_array, data_type)
+            instrumentation.record("decode", start)
+            if data is not None:
+                instrumentation.count("frames")
+            return data
+        except asyncio.TimeoutError:
+            logger.error(f"Error: Timed out reading data from {self.port_name}")
+        except Exception as e:
+            logger.error(f"Error: Failed to read data from the device: {e}")
+        return None
+
+    async def read_modbus_reply(self, function_code: int) -> bytes:
+        header = await self.read_exactly(2)
+        if header[1] == function_code | 0x80:
+            reply = header + await self.read_exactly(3)
+        elif header[1] != function_code:
+            raise ModbusError(f"Unexpected function code {header[1]} in reply")
+        elif function_code == READ_HOLDING_REGISTERS:
+            byte_count = await self.read_exactly(1)
+            reply = header + byte_count + await self.read_exactly(byte_count[0] + 2)
+        else:
+            reply = header + await self.read_exactly(6)
+        if not checkCRC(reply[:-2], struct.unpack(">H", reply[-2:])[0]):
+            raise ModbusError("Modbus reply CRC check failed")
+        if reply[1] & 0x80:
+            raise ModbusError(f"Modbus exception code {reply[2]}")
+        return reply
+
+    async def read_registers(self, address: int, count: int, timeout: float = None):
+        # Holding registers as a list of ints, or None on failure like
+        # data_api.read_modbus_block
+        try:
+            reply = await self.request(
+                modbus_request(self.slave_id, READ_HOLDING_REGISTERS, address, count),
+                lambda: self.read_modbus_reply(READ_HOLDING_REGISTERS),
+                timeout,
+            )
+            return list(struct.unpack(f">{count}H", reply[3:-2]))
+        except asyncio.TimeoutError:
+            logger.error(f"Error: Timed out reading Modbus registers {address}+{count}")
+        except Exception as e:
+            logger.error(f"Error reading Modbus registers {address}+{count}: {e}")
+        return None
+
+    async def read_modbus(self, address: int, data_type: DataType, timeout=None):
+        count = 1 if data_type == DataType.UINT16 else 2
+        registers = await self.read_registers(address, count, timeout)
+        if registers is None:
+            return None
+        return data_api.decode_data(registers, data_type)
+
+    async def write_modbus(self, address: int, value: int, timeout: float = None):
+        # Returns True once the device echoed the write
+        try:
+            await self.request(
+                modbus_request(self.slave_id, WRITE_SINGLE_REGISTER, address, value),
+                lambda: self.read_modbus_reply(WRITE_SINGLE_REGISTER),
+                timeout,
+            )
+            logger.info(f"Write {value} to addres {address} on unit {self.slave_id}")
+            return True
+        except asyncio.TimeoutError:
+            logger.error(f"Error: Timed out writing Modbus register {address}")
+        except Exception as e:
+            logger.error(f"Error writing Modbus register {address}: {e}")
+        return False
+
+
+async def demo(port_name: str, seconds: float):
+    # Frame acquisition, indicator polling and a command write sharing one
+    # event loop and one port
+    frame_period = ConfigSingleton().get_config()["CUSTOM_PROTOCO_FREQUENCY"] / 1000
+    command = ConfigSingleton().get_config()["READ_SIN_DATA_CMD"]
+    address = ConfigSingleton().get_config()["TEMP_STABLE_INDICATOR_ADDRESS"]
+    counts = {"frames": 0, "polls": 0}
+
+    async def acquire(transport: AsyncTransport):
+        deadline = time.monotonic()
+        while True:
+            data = await transport.read_custom_data(command, DataType.FLOAT32)
+            counts["frames"] += data is not None
+            deadline += frame_period
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+    async def poll(transport: AsyncTransport):
+        while True:
+            counts["polls"] += await transport.read_registers(address, 1) is not None
+            await asyncio.sleep(1)
+
+    async with AsyncTransport(port_name) as transport:
+        await transport.write_modbus(address, 2)
+        tasks = [
+            asyncio.create_task(acquire(transport)),
+            asyncio.create_task(poll(transport)),
+        ]
+        await asyncio.sleep(seconds)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    print(f"{counts['frames']} frames and {counts['polls']} polls in {seconds} s")
+
+
+if __name__ == "__main__":
+    # python async_transport.py [port|EMULATOR] [seconds]
+    logging.basicConfig(level=logging.WARNING)
+    port_name = sys.argv[1] if len(sys.argv) > 1 else "EMULATOR"
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    emulator = None
+    if port_name == "EMULATOR":
+        from emulator import DeviceEmulator
+
+        data_api.FAKE_CUSTOM_DATA = 0
+        emulator = DeviceEmulator(baudrate=0)
+        port_name = emulator.start()
+    try:
+        asyncio.run(demo(port_name, seconds))
+    finally:
+        if emulator is not None:
+            emulator.stop()
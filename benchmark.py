@@ -0,0 +1,429 @@
+import argparse
+import json
+import platform
+import struct
+import subprocess
+import sys
+import time
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import custom_data
+import data_api
+import fft
+import frame_chart
+from dsp_worker import dsp_worker
+from config import ConfigSingleton
+from custom_data import CustomData, DataMode
+from data_api import DataType
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+CUSTOM_PROTOCO_FREQUENCY = ConfigSingleton().get_config()["CUSTOM_PROTOCO_FREQUENCY"]
+CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT = ConfigSingleton().get_config()[
+    "CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT"
+]
+READ_SIN_DATA_CMD = ConfigSingleton().get_config()["READ_SIN_DATA_CMD"]
+
+WINDOW_SECONDS = [15, 60, 300]
+SAMPLE_RATES = [1000, 10000]
+
+
+def measure(func, min_time=0.5, min_runs=3, max_runs=10000, setup=None):
+    # Calls setup() (untimed) then func() (timed) until both min_time and
+    # min_runs are reached, returns per-call timings in microseconds
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < max_runs and (
+        len(timings) < min_runs or time.perf_counter() - start < min_time
+    ):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - t0) * 1e6)
+    return summarize(timings)
+
+
+def summarize(timings):
+    timings = np.array(timings)
+    return {
+        "runs": len(timings),
+        "mean_us": float(timings.mean()),
+        "median_us": float(np.median(timings)),
+        "min_us": float(timings.min()),
+        "max_us": float(timings.max()),
+    }
+
+
+def make_frame(samples, data_type: DataType) -> bytes:
+    payload = data_api.encode_frame(samples, data_type)
+    frame = bytes.fromhex(READ_SIN_DATA_CMD)[:3] + struct.pack(">H", len(payload))
+    frame = (frame + payload).ljust(
+        len(payload) + CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT - 2, b"\0"
+    )
+    return frame + b"\0\0"
+
+
+class FrameDevice:
+    # Serial stand-in that answers every command with the same frame, so
+    # read_custom_data is measured without I/O
+    def __init__(self, frame: bytes) -> None:
+        self.frame = frame
+
+    def write(self, data):
+        return len(data)
+
+    def read(self, size):
+        return self.frame[:size]
+
+
+class HeadlessWidget:
+    def pack(self, **kwargs):
+        pass
+
+    def winfo_viewable(self):
+        return True
+
+
+class HeadlessCanvas(FigureCanvasAgg):
+    def __init__(self, figure, master=None):
+        super().__init__(figure)
+
+    def get_tk_widget(self):
+        return HeadlessWidget()
+
+    def blit(self, bbox=None):
+        pass
+
+
+class HeadlessMaster:
+    def after(self, ms, func):
+        return None
+
+    def after_cancel(self, event_id):
+        pass
+
+
+class Entry:
+    def __init__(self, text="") -> None:
+        self.text = text
+
+    def get(self):
+        return self.text
+
+
+def configure(window_seconds, sample_rate):
+    # The modules read these from config.yaml at import time
+    for module in (custom_data, frame_chart):
+        module.DISPLAY_TIME_RANGE = window_seconds
+        module.DATA_FREQUENCY = sample_rate
+
+
+def frame_samples(sample_rate):
+    return int(sample_rate * CUSTOM_PROTOCO_FREQUENCY / 1000)
+
+
+def make_custom_data(window_seconds, sample_rate):
+    configure(window_seconds, sample_rate)
+    data = CustomData(None)
+    samples = frame_samples(sample_rate)
+
+    def feed(frames=1):
+        for _ in range(frames):
+            signal = np.random.normal(0, 1, samples)
+            data.process_data(
+                [(data.timebases[DataMode.SIN].next_frame(samples), signal)],
+                data.original_sin_data,
+                data.processed_sin_data,
+                DataMode.SIN,
+            )
+
+    # Fill the whole window first
+    feed(int(np.ceil(window_seconds * sample_rate / samples)))
+    return data, feed
+
+
+def bench_decode_data():
+    for data_type, registers in [
+        (DataType.UINT16, [0x1234]),
+        (DataType.UINT32, [0x1234, 0x5678]),
+        (DataType.FLOAT32, [0x1234, 0x5678]),
+    ]:
+        yield {"data_type": data_type.name}, measure(
+            lambda: data_api.decode_data(registers, data_type)
+        )
+
+
+def bench_read_custom_data():
+    data_api.FAKE_CUSTOM_DATA = 0
+    for sample_rate in SAMPLE_RATES:
+        samples = frame_samples(sample_rate)
+        for data_type in (DataType.UINT32, DataType.FLOAT32):
+            values = np.arange(samples).astype(data_api.FRAME_DTYPES[data_type])
+            frame = make_frame(values, data_type)
+            data_api.CUSTOM_PROTOCO_DATA_BYTE_COUNT = samples * 4
+            device = FrameDevice(frame)
+            yield {
+                "data_type": data_type.name,
+                "frame_samples": samples,
+                "frame_bytes": len(frame),
+            }, measure(
+                lambda: data_api.read_custom_data(device, READ_SIN_DATA_CMD, data_type)
+            )
+
+
+def bench_read_custom_data_pty():
+    if not sys.platform.startswith("linux"):
+        return
+    from connect import connect_port
+    from emulator import DeviceEmulator
+
+    data_api.FAKE_CUSTOM_DATA = 0
+    data_api.CUSTOM_PROTOCO_DATA_BYTE_COUNT = ConfigSingleton().get_config()[
+        "CUSTOM_PROTOCO_DATA_BYTE_COUNT"
+    ]
+    with DeviceEmulator(baudrate=0) as emulator:
+        client = connect_port(emulator.port)
+        client.connect()
+        frame_bytes = (
+            data_api.CUSTOM_PROTOCO_DATA_BYTE_COUNT
+            + CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT
+        )
+        yield {"frame_bytes": frame_bytes}, measure(
+            lambda: data_api.read_custom_data(
+                client.socket, READ_SIN_DATA_CMD, DataType.FLOAT32
+            )
+        )
+        client.close()
+
+
+def bench_crc():
+    for sample_rate in SAMPLE_RATES:
+        data = np.random.bytes(frame_samples(sample_rate) * 4 + 7)
+        crc = data_api.calculate_crc(data)
+        yield {"function": "calculate_crc", "frame_bytes": len(data) + 2}, measure(
+            lambda: data_api.calculate_crc(data)
+        )
+        yield {"function": "validate_crc", "frame_bytes": len(data) + 2}, measure(
+            lambda: data_api.validate_crc(data, crc)
+        )
+        # A recording's worth of frames, reported per frame
+        for frame_count in (100, 10000):
+            frames = np.frombuffer(
+                np.random.bytes(frame_count * (len(data) + 2)), dtype=np.uint8
+            ).reshape(frame_count, len(data) + 2)
+            result = measure(lambda: data_api.validate_crc_batch(frames))
+            yield {
+                "function": "validate_crc_batch",
+                "frame_bytes": len(data) + 2,
+                "frames": frame_count,
+                "per_frame_us": result["median_us"] / frame_count,
+            }, result
+
+
+def bench_process_data():
+    for window_seconds in WINDOW_SECONDS:
+        for sample_rate in SAMPLE_RATES:
+            data, feed = make_custom_data(window_seconds, sample_rate)
+            signal = np.random.normal(0, 1, frame_samples(sample_rate))
+            frames = []
+
+            def setup():
+                frames[:] = [
+                    (data.timebases[DataMode.SIN].next_frame(len(signal)), signal)
+                ]
+
+            yield {
+                "window_seconds": window_seconds,
+                "sample_rate": sample_rate,
+                "frame_samples": len(signal),
+            }, measure(
+                lambda: data.process_data(
+                    frames,
+                    data.original_sin_data,
+                    data.processed_sin_data,
+                    DataMode.SIN,
+                ),
+                setup=setup,
+            )
+            data.stop()
+
+
+def window_signals():
+    for window_seconds in WINDOW_SECONDS:
+        for sample_rate in SAMPLE_RATES:
+            yield window_seconds, sample_rate, np.random.normal(
+                0, 1, window_seconds * sample_rate
+            )
+
+
+def bench_fft():
+    for window_seconds, sample_rate, signal in window_signals():
+        params = {"window_seconds": window_seconds, "sample_rate": sample_rate}
+        yield {"function": "fft", **params}, measure(
+            lambda: fft.fft(signal, sample_rate)
+        )
+        spectrum = fft.Spectrum(sample_rate)
+        yield {"function": "Spectrum.compute", **params}, measure(
+            lambda: spectrum.compute(signal)
+        )
+        # One frame into a spectrogram already holding the whole window
+        stft = fft.StreamingSTFT(
+            sample_rate, history=window_seconds * sample_rate // 128
+        )
+        stft.process(np.arange(len(signal)) / sample_rate, signal)
+        frame = signal[: frame_samples(sample_rate)]
+        # Each frame continues the stream where the previous one ended
+        frame_times = [np.arange(len(signal) - len(frame), len(signal)) / sample_rate]
+
+        def setup():
+            frame_times[0] = frame_times[0] + len(frame) / sample_rate
+
+        yield {
+            "function": "StreamingSTFT.process",
+            "frame_samples": len(frame),
+            "history": stft.spectra.capacity,
+            **params,
+        }, measure(lambda: stft.process(frame_times[0], frame), setup=setup)
+
+
+def bench_filter():
+    for window_seconds, sample_rate, signal in window_signals():
+        params = {"window_seconds": window_seconds, "sample_rate": sample_rate}
+        yield {"function": "filter", **params}, measure(
+            lambda: fft.filter(signal, sample_rate, "30", "10")
+        )
+        streaming_filter = fft.StreamingFilter(sample_rate)
+        streaming_filter.set_cutoffs("30", "10")
+        frame = signal[: frame_samples(sample_rate)]
+        yield {
+            "function": "StreamingFilter.process",
+            "frame_samples": len(frame),
+            **params,
+        }, measure(lambda: streaming_filter.process(frame))
+
+
+def bench_chart_update():
+    frame_chart.FigureCanvasTkAgg = HeadlessCanvas
+    # DSP and drawing in the same call, as in the Tk thread with DSP_WORKER 0
+    dsp_worker.threaded = False
+    for window_seconds in WINDOW_SECONDS:
+        for sample_rate in SAMPLE_RATES:
+            data, feed = make_custom_data(window_seconds, sample_rate)
+            params = {"window_seconds": window_seconds, "sample_rate": sample_rate}
+            time_chart = frame_chart.TimeChart(
+                data, HeadlessMaster(), Entry("30"), Entry("")
+            )
+            yield {"chart": "TimeChart", **params}, measure(
+                time_chart.update, setup=feed
+            )
+            fft_chart = frame_chart.FFTChart(data, HeadlessMaster())
+            yield {"chart": "FFTChart", **params}, measure(fft_chart.update, setup=feed)
+            spectrogram_chart = frame_chart.SpectrogramChart(data, HeadlessMaster())
+            yield {"chart": "SpectrogramChart", **params}, measure(
+                spectrogram_chart.update, setup=feed
+            )
+            time_chart.stop()
+            fft_chart.stop()
+            spectrogram_chart.stop()
+            data.stop()
+
+
+def bench_startup():
+    # Wall time of a fresh interpreter importing each entry point, as when
+    # the app is restarted. app.py imports frame_chart in the background.
+    for module in ("app", "headless", "frame_chart"):
+        yield {"function": f"import {module}"}, measure(
+            lambda: subprocess.run(
+                [sys.executable, "-c", f"import {module}"], check=True
+            ),
+            min_time=0,
+            min_runs=5,
+        )
+    if not sys.platform.startswith("linux"):
+        return
+    from bus import Bus
+    from connect import connect_port
+    from emulator import DeviceEmulator
+
+    # From starting acquisition to the first frame processed, on the emulator
+    data_api.FAKE_CUSTOM_DATA = 0
+    configure(
+        ConfigSingleton().get_config()["DISPLAY_TIME_RANGE"],
+        ConfigSingleton().get_config()["DATA_FREQUENCY"],
+    )
+    latencies = []
+    for _ in range(5):
+        with DeviceEmulator(baudrate=0) as emulator:
+            client = connect_port(emulator.port)
+            client.connect()
+            bus = Bus(client)
+            data = CustomData(bus)
+            data.set_mode(DataMode.SIN)
+            deadline = time.monotonic() + 5
+            while data.first_frame_latency is None and time.monotonic() < deadline:
+                time.sleep(0.001)
+            data.stop()
+            bus.stop()
+            client.close()
+            if data.first_frame_latency is not None:
+                latencies.append(data.first_frame_latency * 1e6)
+    if latencies:
+        yield {"function": "first frame"}, summarize(latencies)
+
+
+BENCHMARKS = {
+    "decode_data": bench_decode_data,
+    "read_custom_data": bench_read_custom_data,
+    "read_custom_data_pty": bench_read_custom_data_pty,
+    "crc": bench_crc,
+    "process_data": bench_process_data,
+    "fft": bench_fft,
+    "filter": bench_filter,
+    "chart_update": bench_chart_update,
+    "startup": bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sensor hot paths")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}",
+    )
+    parser.add_argument("-o", "--output", help="append JSON lines to this file")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.WARNING)
+    output = open(args.output, "a") if args.output else None
+    context = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+    try:
+        for name in args.benchmarks or BENCHMARKS:
+            for params, result in BENCHMARKS[name]():
+                line = json.dumps({"benchmark": name, **params, **result, **context})
+                print(line, flush=True)
+                if output:
+                    output.write(line + "\n")
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import itertools
+import queue
+import threading
+import time
+from pymodbus.client.sync import ModbusSerialClient as ModbusClient
+from config import ConfigSingleton
+
+from enum import Enum
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BAUDRATE = ConfigSingleton().get_config()["BAUDRATE"]
+
+
+class TransactionClass(Enum):
+    # Values are queue priorities, lower runs first
+    DATA = 0
+    WRITE = 1
+    POLL = 2
+
+
+def rtu_frame_gap(baudrate):
+    # Modbus RTU needs 3.5 character times of silence between frames, an RTU
+    # character is 11 bits. Above 19200 baud the spec fixes it at 1.75 ms.
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * 11 / baudrate
+
+
+class Transaction:
+    def __init__(self, func, transaction_class: TransactionClass) -> None:
+        self.func = func
+        self.transaction_class = transaction_class
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"{self.transaction_class.name} transaction timed out")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Bus:
+    # Single owner of the serial port shared by the custom frame protocol and
+    # Modbus RTU. Transactions are queued by class (data frames, then writes,
+    # then status polls) and run one at a time on the bus thread with the RTU
+    # inter-frame gap between them.
+    def __init__(self, modbus_client: ModbusClient, baudrate=BAUDRATE) -> None:
+        self.client = modbus_client
+        self.frame_gap = rtu_frame_gap(baudrate)
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.stop_flag = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="bus")
+        self.thread.daemon = True
+
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.busy_time = 0.0
+        self.stats = {
+            transaction_class: {"count": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for transaction_class in TransactionClass
+        }
+        self.thread.start()
+
+    def submit(self, func, transaction_class: TransactionClass) -> Transaction:
+        # func(modbus_client) runs on the bus thread, use the returned
+        # Transaction to wait for its result
+        transaction = Transaction(func, transaction_class)
+        if self.stop_flag.is_set():
+            transaction.error = RuntimeError("Bus stopped")
+            transaction.done.set()
+            return transaction
+        self.queue.put((transaction_class.value, next(self.sequence), transaction))
+        return transaction
+
+    def call(self, func, transaction_class: TransactionClass, timeout=None):
+        return self.submit(func, transaction_class).wait(timeout)
+
+    def stop(self):
+        self.stop_flag.set()
+        self.queue.put((-1, next(self.sequence), None))
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+        # Fail whatever is still queued so no caller waits forever
+        while True:
+            try:
+                _, _, transaction = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if transaction is not None:
+                transaction.error = RuntimeError("Bus stopped")
+                transaction.done.set()
+
+    def get_stats(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            return {
+                "utilization": self.busy_time / elapsed if elapsed else 0.0,
+                "queue_length": self.queue.qsize(),
+                **{
+                    transaction_class.name: {
+                        "count": stats["count"],
+                        "mean_wait_ms": (
+                            stats["total_wait"] / stats["count"] * 1000
+                            if stats["count"]
+                            else 0.0
+                        ),
+                        "max_wait_ms": stats["max_wait"] * 1000,
+                    }
+                    for transaction_class, stats in self.stats.items()
+                },
+            }
+
+    def run(self):
+        last_end = 0.0
+        while not self.stop_flag.is_set():
+            _, _, transaction = self.queue.get()
+            if transaction is None:
+                break
+
+            gap = last_end + self.frame_gap - time.monotonic()
+            if gap > 0:
+                time.sleep(gap)
+
+            start = time.monotonic()
+            try:
+                transaction.result = transaction.func(self.client)
+            except Exception as e:
+                transaction.error = e
+            last_end = time.monotonic()
+
+            wait = start - transaction.submitted
+            with self.lock:
+                self.busy_time += last_end - start
+                stats = self.stats[transaction.transaction_class]
+                stats["count"] += 1
+                stats["total_wait"] += wait
+                stats["max_wait"] = max(stats["max_wait"], wait)
+            transaction.done.set()
@@ -17,7 +17,10 @@ class ConfigSingleton:
     def load_config(self):
         try:
             with open("config.yaml", "r") as file:
-                self.config_data = yaml.safe_load(file)
+                # The C loader when PyYAML was built with libyaml
+                self.config_data = yaml.load(
+                    file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+                )
         except FileNotFoundError:
             self.config_data = {}
         except Exception as e:
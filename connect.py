@@ -1,7 +1,10 @@
 import serial
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from serial.tools import list_ports
 from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 from config import ConfigSingleton
+from data_api import custom_frame_length, read_modbus_block, validate_crc
 
 import logging
 
@@ -9,6 +12,15 @@ logger = logging.getLogger(__name__)
 
 BAUDRATE = ConfigSingleton().get_config()["BAUDRATE"]
 SLAVE_ID = ConfigSingleton().get_config()["SLAVE_ID"]
+PORT_PROBE_TIMEOUT = ConfigSingleton().get_config()["PORT_PROBE_TIMEOUT"]
+PORT_PROBE_WORKERS = ConfigSingleton().get_config()["PORT_PROBE_WORKERS"]
+LAST_PORT_FILE = ConfigSingleton().get_config()["LAST_PORT_FILE"]
+DEVICE_PORT = ConfigSingleton().get_config()["DEVICE_PORT"]
+PROBE_ADDRESS = ConfigSingleton().get_config()["TEMP_STABLE_INDICATOR_ADDRESS"]
+READ_SIN_DATA_CMD = ConfigSingleton().get_config()["READ_SIN_DATA_CMD"]
+CUSTOM_PROTOCO_DATA_BYTE_COUNT = ConfigSingleton().get_config()[
+    "CUSTOM_PROTOCO_DATA_BYTE_COUNT"
+]
 
 
 def connect_port(port_name, baudrate=BAUDRATE, timeout=5):
@@ -16,6 +28,8 @@ def connect_port(port_name, baudrate=BAUDRATE, timeout=5):
         # Try to open the serial port
         ser = serial.Serial(port=port_name, baudrate=baudrate, timeout=timeout)
         time.sleep(0.1)  # Wait for a short time to ensure proper initialization
+        # Only checks that the port opens, the Modbus client opens its own
+        ser.close()
 
         # Try to create a Modbus RTU client for the port
         modbus_client = ModbusClient(
@@ -38,21 +52,123 @@ def connect_port(port_name, baudrate=BAUDRATE, timeout=5):
         return None
 
 
+def load_last_port():
+    try:
+        with open(LAST_PORT_FILE, "r") as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+
+def save_last_port(port_name):
+    try:
+        with open(LAST_PORT_FILE, "w") as file:
+            file.write(port_name)
+    except OSError as e:
+        logger.error(f"Can't save last port to {LAST_PORT_FILE}: {e}")
+
+
+def list_port_names():
+    # USB serial adapters first, they are what the device shows up as
+    port_names = [port.device for port in list_ports.comports()]
+    return sorted(
+        port_names,
+        key=lambda name: (
+            not any(kind in name for kind in ("ttyUSB", "ttyACM", "COM")),
+            name,
+        ),
+    )
+
+
+def handshake(modbus_client: ModbusClient):
+    # A port only counts as the device if it answers a Modbus read or the
+    # custom read command
+    if read_modbus_block(modbus_client, PROBE_ADDRESS, 1) is not None:
+        return True
+    total_count = custom_frame_length()
+    command = bytes.fromhex(READ_SIN_DATA_CMD)
+    try:
+        modbus_client.socket.reset_input_buffer()
+        modbus_client.socket.write(command)
+        reply = modbus_client.socket.read(total_count)
+    except Exception as e:
+        logger.debug(f"Custom handshake failed: {e}")
+        return False
+    # The reply echoes the command's first three bytes, then gives the data
+    # byte count and ends in a CRC sent low byte first. The CRC is checked
+    # even with DISABLE_CRC, any reply of the right length isn't enough.
+    return (
+        len(reply) == total_count
+        and reply[:3] == command[:3]
+        and int.from_bytes(reply[3:5], "big") == CUSTOM_PROTOCO_DATA_BYTE_COUNT
+        and validate_crc(reply[:-2], int.from_bytes(reply[-2:], "little"))
+    )
+
+
+def probe_port(port_name, baudrate=BAUDRATE, timeout=PORT_PROBE_TIMEOUT):
+    client = connect_port(port_name, baudrate, timeout)
+    if client is None:
+        return False
+    try:
+        return handshake(client)
+    finally:
+        client.close()
+
+
 def scan_ports_and_connect(baudrate=BAUDRATE, timeout=5):
-    # List of common Modbus RTU port names to scan
-    port_names = [
-        "COM{}".format(i) for i in range(1, 33)
-    ]  # Assuming up to 32 COM ports, adjust as needed for your system
+    # Tries the last port that answered first, then probes every listed
+    # port concurrently with a short timeout
+    last_port = load_last_port()
+    if last_port and probe_port(last_port, baudrate):
+        logger.info(f"Device answered on last used port {last_port}")
+        client = connect_port(last_port, baudrate, timeout)
+        return [client] if client else []
 
-    modbus_clients = []
+    port_names = [name for name in list_port_names() if name != last_port]
+    if not port_names:
+        return []
+    found = []
+    with ThreadPoolExecutor(max_workers=PORT_PROBE_WORKERS) as executor:
+        futures = {
+            executor.submit(probe_port, port_name, baudrate): port_name
+            for port_name in port_names
+        }
+        for future in as_completed(futures):
+            if future.result():
+                found.append(futures[future])
+    logger.info(f"Device answered on {found} out of {port_names}")
 
-    for port_name in port_names:
+    modbus_clients = []
+    for port_name in sorted(found):
         client = connect_port(port_name, baudrate, timeout)
         if client:
             modbus_clients.append(client)
+    if len(found) == 1:
+        save_last_port(found[0])
     return modbus_clients
 
 
+def connect_device(device_port=DEVICE_PORT):
+    # Returns (modbus_client, emulator) for DEVICE_PORT, emulator is None
+    # unless device_port is "EMULATOR"
+    emulator = None
+    if device_port == "EMULATOR":
+        # Local pty device emulator, Linux only
+        from emulator import DeviceEmulator
+
+        emulator = DeviceEmulator()
+        client = connect_port(emulator.start())
+        assert client is not None, "Can't connect to the device emulator"
+    elif device_port:
+        client = connect_port(device_port)
+        assert client is not None, f"Can't connect to port {device_port}"
+    else:
+        clients = scan_ports_and_connect()
+        assert len(clients) == 1, "Can't find proper port to connect"
+        client = clients[0]
+    return client, emulator
+
+
 if __name__ == "__main__":
     modbus_clients = scan_ports_and_connect()
 
@@ -1,16 +1,19 @@
 import time
 import threading
 from config import ConfigSingleton
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-from data_api import read_modbus, DataType, read_custom_data
-import sched
-import customtkinter
-
-from datetime import datetime, timedelta
+from data_api import DataType, read_custom_data
+from bus import Bus, TransactionClass
+from acquisition import Acquisition, LatePolicy
+from frame_queue import FrameQueue, OverflowPolicy
+import numpy as np
 
 from enum import Enum
-from collections import deque
-import csv
+from ring_buffer import RingBuffer
+from history import TieredHistory
+from instrumentation import instrumentation
+from timebase import Timebase
+from recording import Recorder, RecordingHeader
+from publisher import FramePublisher
 
 import logging
 
@@ -20,188 +23,384 @@ logger = logging.getLogger(__name__)
 class DataMode(Enum):
     SIN = 0
     DDS = 1
+    BOTH = 2  # SIN and DDS read back to back on every frame deadline
 
 
 READ_SIN_DATA_CMD = ConfigSingleton().get_config()["READ_SIN_DATA_CMD"]
 READ_DDS_DATA_CMD = ConfigSingleton().get_config()["READ_DDS_DATA_CMD"]
 CUSTOM_PROTOCO_FREQUENCY = ConfigSingleton().get_config()["CUSTOM_PROTOCO_FREQUENCY"]
-SLEEP_TIME_MS = ConfigSingleton().get_config()["SLEEP_TIME_MS"]
 DATA_PRINT_AVG_COUNT = ConfigSingleton().get_config()["DATA_PRINT_AVG_COUNT"]
 DISPLAY_TIME_RANGE = ConfigSingleton().get_config()["DISPLAY_TIME_RANGE"]
 DATA_FREQUENCY = ConfigSingleton().get_config()["DATA_FREQUENCY"]
+RECORDING_DIR = ConfigSingleton().get_config()["RECORDING_DIR"]
+HISTORY_LEVELS = ConfigSingleton().get_config()["HISTORY_LEVELS"]
+ACQUISITION_LATE_POLICY = LatePolicy(
+    ConfigSingleton().get_config()["ACQUISITION_LATE_POLICY"]
+)
+ACQUISITION_STATS_INTERVAL = ConfigSingleton().get_config()[
+    "ACQUISITION_STATS_INTERVAL"
+]
+FRAME_QUEUE_SIZE = ConfigSingleton().get_config()["FRAME_QUEUE_SIZE"]
+FRAME_QUEUE_POLICY = OverflowPolicy(
+    ConfigSingleton().get_config()["FRAME_QUEUE_POLICY"]
+)
+
+DATA_TYPES = {DataMode.SIN: DataType.FLOAT32, DataMode.DDS: DataType.UINT32}
+READ_COMMANDS = {DataMode.SIN: READ_SIN_DATA_CMD, DataMode.DDS: READ_DDS_DATA_CMD}
+# Channels acquired in each data mode
+CHANNELS = {
+    DataMode.SIN: (DataMode.SIN,),
+    DataMode.DDS: (DataMode.DDS,),
+    DataMode.BOTH: (DataMode.SIN, DataMode.DDS),
+}
 
 
 class CustomData:
     def __init__(
         self,
-        modbus_client: ModbusClient,
-        scheduler: sched.scheduler,
+        bus: Bus,
         data_mode: DataMode = DataMode.SIN,
+        publisher: FramePublisher = None,
     ) -> None:
-        self.client = modbus_client
-        self.scheduler = scheduler
+        self.bus = bus
+        self.publisher = publisher
         self.data_mode = data_mode
-        self.stop_flag = threading.Event()
+        # Channel shown by the get_*_data() accessors, SIN or DDS
+        self.display_mode = CHANNELS[data_mode][0]
         self.processor = threading.Thread(
             target=self.process,
         )
         self.processor.daemon = True
         self.lock = threading.Lock()
-        self.current_time = None
-        self.sin_data = deque(maxlen=10)
-        self.dds_data = deque(maxlen=10)
-
-        self.original_sin_data = deque(maxlen=int(DISPLAY_TIME_RANGE * DATA_FREQUENCY))
-        self.original_dds_data = deque(maxlen=int(DISPLAY_TIME_RANGE * DATA_FREQUENCY))
-
-        self.processed_sin_data = deque(
-            maxlen=int(DISPLAY_TIME_RANGE * DATA_FREQUENCY / DATA_PRINT_AVG_COUNT)
+        # Both channels count samples from one start, anchored at the first
+        # frame read on either, so in BOTH mode their frames line up
+        timebase = Timebase(DATA_FREQUENCY)
+        self.timebases = {
+            DataMode.SIN: timebase,
+            DataMode.DDS: timebase,
+        }
+        self.channel_stats = {
+            channel: {"frames": 0, "samples": 0, "failed": 0, "first_time": None}
+            for channel in (DataMode.SIN, DataMode.DDS)
+        }
+        # (data_mode, index, response, queued at) frames waiting for the
+        # processor
+        self.frames = FrameQueue(FRAME_QUEUE_SIZE, FRAME_QUEUE_POLICY)
+
+        self.original_sin_data = RingBuffer(int(DISPLAY_TIME_RANGE * DATA_FREQUENCY))
+        self.original_dds_data = RingBuffer(int(DISPLAY_TIME_RANGE * DATA_FREQUENCY))
+
+        self.processed_sin_data = RingBuffer(
+            int(DISPLAY_TIME_RANGE * DATA_FREQUENCY / DATA_PRINT_AVG_COUNT)
         )
-        self.processed_dds_data = deque(
-            maxlen=int(DISPLAY_TIME_RANGE * DATA_FREQUENCY / DATA_PRINT_AVG_COUNT)
+        self.processed_dds_data = RingBuffer(
+            int(DISPLAY_TIME_RANGE * DATA_FREQUENCY / DATA_PRINT_AVG_COUNT)
         )
 
-        self.sin_file = open("sin.csv", "w", newline="")
-        self.sin_csv_writer = csv.writer(self.sin_file)
+        # Downsampled raw samples for time ranges beyond DISPLAY_TIME_RANGE
+        self.histories = {
+            DataMode.SIN: TieredHistory(DATA_FREQUENCY, HISTORY_LEVELS),
+            DataMode.DDS: TieredHistory(DATA_FREQUENCY, HISTORY_LEVELS),
+        }
 
-        self.dds_file = open("dds.csv", "w", newline="")
-        self.dds_csv_writer = csv.writer(self.dds_file)
+        self.recorders = {}
+        self.recorder_lock = threading.Lock()
         self.download_on = False
 
         self.running = False
-
-        self.scheduler_id = None
+        # perf_counter() when acquisition started and seconds until its
+        # first frame was processed
+        self.start_time = None
+        self.first_frame_latency = None
+
+        self.acquisition = Acquisition(
+            CUSTOM_PROTOCO_FREQUENCY / 1000,
+            self.refresh,
+            ACQUISITION_LATE_POLICY,
+            ACQUISITION_STATS_INTERVAL,
+        )
 
     def __del__(self):
         self.stop()
 
     def get_processed_data(self):
+        # Returns (times, values) copies of the current window, times are
+        # seconds since the displayed channel's timebase start
         with self.lock:
-            if self.data_mode == DataMode.SIN:
-                return self.processed_sin_data
+            if self.display_mode == DataMode.SIN:
+                times, values = self.processed_sin_data.latest()
             else:
-                return self.processed_dds_data
+                times, values = self.processed_dds_data.latest()
+            return times.copy(), values.copy()
 
     def get_original_data(self):
         with self.lock:
-            if self.data_mode == DataMode.SIN:
-                return self.original_sin_data
+            if self.display_mode == DataMode.SIN:
+                times, values = self.original_sin_data.latest()
+            else:
+                times, values = self.original_dds_data.latest()
+            return times.copy(), values.copy()
+
+    def get_new_processed_data(self, since: int):
+        # Returns the displayed channel, the processed sample count and the samples
+        # appended after the first `since` ones (at most one window)
+        with self.lock:
+            if self.display_mode == DataMode.SIN:
+                buffer = self.processed_sin_data
+            else:
+                buffer = self.processed_dds_data
+            times, values = buffer.latest(max(buffer.count - since, 0))
+            return self.display_mode, buffer.count, times.copy(), values.copy()
+
+    def get_new_original_data(self, since: int):
+        # Same as get_new_processed_data for the raw samples
+        with self.lock:
+            if self.display_mode == DataMode.SIN:
+                buffer = self.original_sin_data
+            else:
+                buffer = self.original_dds_data
+            times, values = buffer.latest(max(buffer.count - since, 0))
+            return self.display_mode, buffer.count, times.copy(), values.copy()
+
+    def get_history(self, seconds: float, max_points: int):
+        # Returns the displayed channel and (times, min, mean, max) copies of
+        # its last `seconds` at the history level that fits max_points
+        with self.lock:
+            times, rows = self.histories[self.display_mode].latest(seconds, max_points)
+            return (
+                self.display_mode,
+                times.copy(),
+                rows[:, 0].copy(),
+                rows[:, 1].copy(),
+                rows[:, 2].copy(),
+            )
+
+    def get_data_version(self):
+        # Changes whenever the data returned by get_*_data() changes
+        with self.lock:
+            if self.display_mode == DataMode.SIN:
+                return (self.display_mode, self.original_sin_data.count)
             else:
-                return self.original_dds_data
+                return (self.display_mode, self.original_dds_data.count)
+
+    def get_timebase(self) -> Timebase:
+        with self.lock:
+            return self.timebases[self.display_mode]
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            channels = {}
+            for channel, stats in self.channel_stats.items():
+                elapsed = (
+                    now - stats["first_time"] if stats["first_time"] is not None else 0
+                )
+                # Rates each channel actually achieved since its first frame
+                channels[channel.name] = {
+                    "frames": stats["frames"],
+                    "failed_reads": stats["failed"],
+                    "frame_rate": stats["frames"] / elapsed if elapsed else 0.0,
+                    "sample_rate": stats["samples"] / elapsed if elapsed else 0.0,
+                }
+        stats = {
+            "acquisition": self.acquisition.get_stats(),
+            "frame_queue": self.frames.get_stats(),
+            "channels": channels,
+            "first_frame_latency": self.first_frame_latency,
+            "recording": self.get_recording_stats(),
+        }
+        if self.publisher is not None:
+            stats["publisher"] = self.publisher.get_stats()
+        return stats
 
     def process_data(
-        self, q_data, original_data: deque, processed_data: deque, csv_writer
+        self,
+        frames: list,
+        original_data: RingBuffer,
+        processed_data: RingBuffer,
+        data_mode: DataMode,
     ):
-        if q_data:
-            t, data = q_data.popleft()
-
-            orginal_timed_data = [
-                (t + timedelta(milliseconds=i), x) for i, x in enumerate(data)
-            ]
-            original_data.extend(orginal_timed_data)
-
-            avgs = []
-            for i in range(0, len(data), DATA_PRINT_AVG_COUNT):
-                chunk = data[i : i + DATA_PRINT_AVG_COUNT]
-                if len(chunk) > 0:  # Make sure the chunk is not empty
-                    avgs.append(sum(chunk) / len(chunk))
-
-            timed_data = [
-                (t + timedelta(milliseconds=i * DATA_PRINT_AVG_COUNT), x)
-                for i, x in enumerate(avgs)
-            ]
-
-            processed_data.extend(timed_data)
+        # frames is a batch of (index, response) in acquisition order
+        batch = []
+        for index, response in frames:
+            data = np.asarray(response, dtype=np.float64)
+
+            timebase = self.timebases[data_mode]
+            original_times = timebase.times(index, len(data))
+
+            # Average every DATA_PRINT_AVG_COUNT samples, the last chunk may
+            # be shorter
+            starts = np.arange(0, len(data), DATA_PRINT_AVG_COUNT)
+            avgs = np.add.reduceat(data, starts) / np.diff(np.append(starts, len(data)))
+            processed_times = timebase.times(index, len(data), DATA_PRINT_AVG_COUNT)
+            batch.append((original_times, data, processed_times, avgs))
+
+        with self.lock:
+            for original_times, data, processed_times, avgs in batch:
+                original_data.extend(original_times, data)
+                processed_data.extend(processed_times, avgs)
+                self.histories[data_mode].extend(original_times, data)
+        with self.recorder_lock:
             if self.download_on:
-                csv_writer.writerows([[val] for _, val in orginal_timed_data])
-        else:
-            pass
+                try:
+                    for index, response in frames:
+                        recorder = self.get_recorder(data_mode, len(response))
+                        recorder.write(index, response)
+                except OSError as e:
+                    logger.error(f"Can't record {data_mode.name} frames: {e}")
+                    self.download_on = False
+        if self.publisher is not None:
+            for index, response in frames:
+                self.publisher.publish(
+                    data_mode.value,
+                    DATA_TYPES[data_mode],
+                    index,
+                    timebase.start + index / timebase.sample_rate,
+                    timebase.sample_rate,
+                    response,
+                )
 
     def process(self):
-        while not self.stop_flag.is_set():
-            current_data_mode = DataMode.SIN
-            with self.lock:
-                current_data_mode = self.data_mode
-            if current_data_mode == DataMode.SIN:
-                self.process_data(
-                    self.sin_data,
-                    self.original_sin_data,
-                    self.processed_sin_data,
-                    self.sin_csv_writer,
+        buffers = {
+            DataMode.SIN: (self.original_sin_data, self.processed_sin_data),
+            DataMode.DDS: (self.original_dds_data, self.processed_dds_data),
+        }
+        # Runs until stop() closes the queue and every frame queued before
+        # that is processed, so the recorders get the last frames too
+        while True:
+            frames = self.frames.get_all()
+            if not frames:
+                if self.frames.closed:
+                    break
+                continue
+            dequeued = instrumentation.now()
+            for _, _, _, queued in frames:
+                instrumentation.record("queue_wait", queued, dequeued)
+            for data_mode, (original_data, processed_data) in buffers.items():
+                batch = [
+                    (index, response)
+                    for mode, index, response, _ in frames
+                    if mode == data_mode
+                ]
+                if batch:
+                    start = instrumentation.now()
+                    self.process_data(batch, original_data, processed_data, data_mode)
+                    instrumentation.record("processing", start)
+            if frames and self.first_frame_latency is None:
+                self.first_frame_latency = time.perf_counter() - self.start_time
+                instrumentation.record("startup.first_frame", self.start_time)
+                logger.info(
+                    f"First frame {self.first_frame_latency * 1000:.0f} ms after "
+                    "acquisition started"
                 )
-            else:
-                self.process_data(
-                    self.dds_data,
-                    self.original_dds_data,
-                    self.processed_dds_data,
-                    self.dds_csv_writer,
-                )
-            time.sleep(0.05)
 
     def start(self):
         if not self.processor.is_alive():
             self.processor.start()
 
+    def get_recorder(self, data_mode: DataMode, samples_per_frame: int) -> Recorder:
+        recorder = self.recorders.get(data_mode)
+        if (
+            recorder is not None
+            and recorder.header.samples_per_frame != samples_per_frame
+        ):
+            logger.warning(
+                f"Frame size changed to {samples_per_frame}, starting a new recording"
+            )
+            recorder.close()
+            recorder = None
+        if recorder is None:
+            recorder = Recorder(
+                RECORDING_DIR,
+                data_mode.name.lower(),
+                RecordingHeader(
+                    data_mode.value,
+                    DATA_TYPES[data_mode],
+                    DATA_FREQUENCY,
+                    self.timebases[data_mode].start,
+                    samples_per_frame,
+                ),
+            )
+            self.recorders[data_mode] = recorder
+        return recorder
+
+    def get_recording_stats(self):
+        # Per recording channel: its file, frames written, frames dropped and
+        # whether writing failed
+        with self.recorder_lock:
+            return {
+                data_mode.name: recorder.get_stats()
+                for data_mode, recorder in self.recorders.items()
+            }
+
+    def close_recorders(self):
+        with self.recorder_lock:
+            for recorder in self.recorders.values():
+                recorder.close()
+            self.recorders = {}
+
     def set_download(self, value: bool):
-        self.download_on = value
+        with self.recorder_lock:
+            self.download_on = value
+        if not value:
+            self.close_recorders()
 
     def set_mode(self, data_mode: DataMode):
         with self.lock:
             self.data_mode = data_mode
+            if data_mode != DataMode.BOTH:
+                self.display_mode = data_mode
         if not self.running:
             self.running = True
+            self.start_time = time.perf_counter()
             self.start()
-            self.refresh()
+            self.acquisition.start()
+
+    def set_display_mode(self, display_mode: DataMode):
+        # Picks the channel the charts show, acquisition is unchanged
+        assert display_mode != DataMode.BOTH, "Only one channel can be displayed"
+        with self.lock:
+            self.display_mode = display_mode
 
     def stop(self):
         self.running = False
-        self.stop_flag.set()
+        self.acquisition.stop()
+        self.frames.close()
 
         if self.processor.is_alive():
             self.processor.join(timeout=5)
 
-        if self.sin_file:
-            self.sin_file.close()
-            self.sin_file = None
-
-        if self.dds_file:
-            self.dds_file.close()
-            self.dds_file = None
-
-        if self.scheduler_id:
-            try:
-                self.scheduler.cancel(self.scheduler_id)
-            except:
-                pass
+        self.close_recorders()
 
-    def refresh(
-        self,
-    ) -> None:
+    def refresh(self, deadline: float) -> None:
         current_data_mode = DataMode.SIN
         with self.lock:
             current_data_mode = self.data_mode
-        self.current_time = (
-            datetime.now()
-            if self.current_time is None
-            else self.current_time + timedelta(milliseconds=CUSTOM_PROTOCO_FREQUENCY)
-        )
-        self.client.connect()
-        response = read_custom_data(
-            self.client.socket,
-            READ_SIN_DATA_CMD
-            if current_data_mode == DataMode.SIN
-            else READ_DDS_DATA_CMD,
-            DataType.FLOAT32 if current_data_mode == DataMode.SIN else DataType.UINT32,
-        )
+        for channel in CHANNELS[current_data_mode]:
+            self.read_channel(channel, deadline)
+
+    def read_channel(self, channel: DataMode, deadline: float) -> None:
+        command = READ_COMMANDS[channel]
+
+        def read_frame(client):
+            client.connect()
+            return read_custom_data(client.socket, command, DATA_TYPES[channel])
+
+        response = self.bus.call(read_frame, TransactionClass.DATA)
+        stats = self.channel_stats[channel]
         if response is not None and len(response) > 0:
-            if current_data_mode == DataMode.SIN:
-                self.sin_data.append((self.current_time, response))
-            else:
-                self.dds_data.append((self.current_time, response))
+            # Frames of both channels read at one deadline share its index
+            index = self.timebases[channel].frame_at(deadline, len(response))
+            self.frames.put((channel, index, response, instrumentation.now()))
+            with self.lock:
+                if stats["first_time"] is None:
+                    stats["first_time"] = deadline
+                stats["frames"] += 1
+                stats["samples"] += len(response)
             logger.info(
-                f"Get {len(response)} data points from device at {self.current_time}"
-            )
-        if self.running:
-            self.scheduler_id = self.scheduler.enter(
-                SLEEP_TIME_MS * 1.0 / 1000, 1, self.refresh
+                f"Get {len(response)} {channel.name} data points from device at "
+                f"sample {index}"
             )
+        else:
+            with self.lock:
+                stats["failed"] += 1
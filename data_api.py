@@ -2,9 +2,11 @@ from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 from pymodbus.payload import BinaryPayloadDecoder
 from pymodbus.constants import Endian
 from config import ConfigSingleton
+from instrumentation import instrumentation
 import serial
 import random
 import crcmod
+import functools
 import numpy as np
 
 from enum import Enum
@@ -40,6 +42,37 @@ def decode_data(data, data_type: DataType):
         raise TypeError(f"DataType {data_type} not supported!")
 
 
+# Payload words are big-endian, 32-bit values are sent low word first
+# (byteorder=Endian.Big, wordorder=Endian.Little), so a value is read as
+# two big-endian uint16 words that are swapped before being reinterpreted.
+FRAME_WORD_DTYPE = np.dtype(">u2")
+FRAME_DTYPES = {
+    DataType.UINT32: np.dtype(">u4"),
+    DataType.FLOAT32: np.dtype(">f4"),
+}
+
+
+def decode_frame(data_byte, data_type: DataType) -> np.ndarray:
+    if data_type not in FRAME_DTYPES:
+        raise TypeError(f"DataType {data_type} not supported!")
+    words = np.frombuffer(data_byte, dtype=FRAME_WORD_DTYPE)
+    swapped = np.ascontiguousarray(words.reshape(-1, 2)[:, ::-1])
+    return (
+        swapped.view(FRAME_DTYPES[data_type])
+        .ravel()
+        .astype(FRAME_DTYPES[data_type].newbyteorder("="))
+    )
+
+
+def encode_frame(values, data_type: DataType) -> bytes:
+    # Inverse of decode_frame, used to build device replies
+    if data_type not in FRAME_DTYPES:
+        raise TypeError(f"DataType {data_type} not supported!")
+    data = np.asarray(values).astype(FRAME_DTYPES[data_type])
+    words = data.view(FRAME_WORD_DTYPE).reshape(-1, 2)[:, ::-1]
+    return np.ascontiguousarray(words).tobytes()
+
+
 def read_modbus(
     modbus_client: ModbusClient,
     address,
@@ -71,6 +104,28 @@ def read_modbus(
     return []
 
 
+def read_modbus_block(
+    modbus_client: ModbusClient,
+    address,
+    count,
+):
+    # Reads `count` holding registers in one transaction, returns the raw
+    # registers or None. Logs only failures, it runs on every poll.
+    try:
+        if not modbus_client.is_socket_open():
+            modbus_client.connect()
+        response = modbus_client.read_holding_registers(address, count, unit=SLAVE_ID)
+        if response.isError():
+            logger.error(
+                f"Error reading Modbus registers {address}+{count}: {response}"
+            )
+            return None
+        return response.registers
+    except Exception as e:
+        logger.error(f"Error: {e}")
+    return None
+
+
 def write_modbus(
     modbus_client: ModbusClient,
     address,
@@ -86,15 +141,20 @@ def write_modbus(
         logger.error(f"Error: {e}")
 
 
-def calculate_crc(data, polynomial=0x8005):
-    # Create a CRC calculator with the specified CRC width and polynomial
-    crc_func = crcmod.mkCrcFun(polynomial, initCrc=0, rev=True, xorOut=0xFFFFFFFF)
+@functools.lru_cache(maxsize=None)
+def get_crc_function(polynomial=0x8005):
+    # CRC-16/MODBUS by default, the checksum ending the device's commands and
+    # replies, sent low byte first. Built once per polynomial, crcmod
+    # generates the table and picks its C implementation here. crcmod needs
+    # the x^16 term of a 16-bit polynomial spelled out, so 0x8005 means
+    # 0x18005.
+    if polynomial < 0x10000:
+        polynomial |= 0x10000
+    return crcmod.mkCrcFun(polynomial, initCrc=0xFFFF, rev=True, xorOut=0)
 
-    # Calculate the CRC value for the input data
-    crc = crc_func(data)
 
-    # Return the calculated CRC value
-    return crc
+def calculate_crc(data, polynomial=0x8005):
+    return get_crc_function(polynomial)(data)
 
 
 def validate_crc(data, provided_crc, polynomial=0x8005):
@@ -105,6 +165,20 @@ def validate_crc(data, provided_crc, polynomial=0x8005):
     return calculated_crc == provided_crc
 
 
+def validate_crc_batch(frames: np.ndarray, polynomial=0x8005) -> np.ndarray:
+    # frames is a (frames, bytes) uint8 array of complete frames each ending
+    # in a little-endian CRC, returns a bool per frame
+    frames = np.ascontiguousarray(frames, dtype=np.uint8)
+    provided_crc = frames[:, -1].astype(np.uint32) << 8 | frames[:, -2]
+    crc_func = get_crc_function(polynomial)
+    calculated_crc = np.fromiter(
+        (crc_func(frame.tobytes()) for frame in frames[:, :-2]),
+        dtype=np.uint32,
+        count=len(frames),
+    )
+    return calculated_crc == provided_crc
+
+
 CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT = ConfigSingleton().get_config()[
     "CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT"
 ]
@@ -126,9 +200,34 @@ def get_fake_data():
     return signal
 
 
+def custom_frame_length():
+    return CUSTOM_PROTOCO_DATA_BYTE_COUNT + CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT
+
+
+def parse_custom_frame(byte_array, data_type: DataType):
+    # Checks the CRC of a complete reply frame and decodes its payload,
+    # returns None when the CRC doesn't match
+    total_count = custom_frame_length()
+    assert len(byte_array) == total_count
+    # The CRC is sent low byte first
+    provided_crc = byte_array[total_count - 1] << 8 | byte_array[total_count - 2]
+    if not DISABLE_CRC and not validate_crc(
+        byte_array[: (total_count - 2)], provided_crc
+    ):
+        logger.error("CRC validation failed")
+        return None
+
+    # logger.info("*************************************************")
+    # logger.info("".join(format(byte, "02x") for byte in byte_array))
+    # logger.info("*************************************************")
+    data_byte = byte_array[5 : (5 + CUSTOM_PROTOCO_DATA_BYTE_COUNT)]
+    return decode_frame(data_byte, data_type)
+
+
 def read_custom_data(device: serial.Serial, command, data_type: DataType):
     if FAKE_CUSTOM_DATA:
         return get_fake_data()
+    start = instrumentation.now()
     try:
         device.write(bytes.fromhex(command))  # Send the command as bytes
     except Exception as e:
@@ -137,40 +236,56 @@ def read_custom_data(device: serial.Serial, command, data_type: DataType):
 
     # Read data from the device (assuming the data follows the custom protocol)
     try:
-        total_count = (
-            CUSTOM_PROTOCO_DATA_BYTE_COUNT + CUSTOM_PROTOCO_ADDITIONAL_BYTE_COUNT
-        )
         byte_array = bytearray()
-        byte_array.extend(device.read(total_count))
-        assert len(byte_array) == total_count
-        provided_crc = byte_array[total_count - 2] << 8 | byte_array[total_count - 1]
-        if not DISABLE_CRC and not validate_crc(
-            byte_array[: (total_count - 2)], provided_crc
-        ):
-            logger.error("CRC validation failed")
-            return None
+        byte_array.extend(device.read(custom_frame_length()))
+        instrumentation.record("serial_round_trip", start)
+        instrumentation.count("bytes", len(byte_array))
+        start = instrumentation.now()
+        data = parse_custom_frame(byte_array, data_type)
+        instrumentation.record("decode", start)
+        if data is not None:
+            instrumentation.count("frames")
+        return data
+    except Exception as e:
+        logger.error(f"Error: Failed to read data from the device: {e}")
+        return None
+
 
-        # logger.info("*************************************************")
-        # logger.info("".join(format(byte, "02x") for byte in byte_array))
-        # logger.info("*************************************************")
-        data_byte = byte_array[5 : (5 + CUSTOM_PROTOCO_DATA_BYTE_COUNT)]
-        num_16bit_list = []
-        for i in range(0, len(data_byte), 2):
-            num = (data_byte[i] << 8) | data_byte[i + 1]
-            num_16bit_list.append(num)
+if __name__ == "__main__":
+    # The configured commands carry the same CRC as the replies
+    for name in ("READ_SIN_DATA_CMD", "READ_DDS_DATA_CMD"):
+        command = bytes.fromhex(ConfigSingleton().get_config()[name])
+        assert validate_crc(
+            command[:-2], int.from_bytes(command[-2:], "little")
+        ), f"{name} CRC mismatch"
+        assert validate_crc_batch(np.frombuffer(command, dtype=np.uint8)[None])[0]
+    print("READ_SIN_DATA_CMD and READ_DDS_DATA_CMD pass the CRC check")
+
+    # Check decode_frame against the pymodbus decoder it replaces
+    payload = np.random.bytes(CUSTOM_PROTOCO_DATA_BYTE_COUNT)
+    registers = [
+        (payload[i] << 8) | payload[i + 1]
+        for i in range(0, CUSTOM_PROTOCO_DATA_BYTE_COUNT, 2)
+    ]
+    for data_type in (DataType.UINT32, DataType.FLOAT32):
         decoder = BinaryPayloadDecoder.fromRegisters(
-            num_16bit_list,
-            byteorder=Endian.Big,
-            wordorder=Endian.Little,
+            registers, byteorder=Endian.Big, wordorder=Endian.Little
         )
-        result = []
+        expected = []
         for i in range(0, CUSTOM_PROTOCO_DATA_BYTE_COUNT, 4):
             if data_type == DataType.UINT32:
-                result.append(decoder.decode_32bit_uint())
-            elif data_type == DataType.FLOAT32:
-                result.append(decoder.decode_32bit_float())
-
-        return result
-    except Exception as e:
-        logger.error(f"Error: Failed to read data from the device: {e}")
-        return None
+                expected.append(decoder.decode_32bit_uint())
+            else:
+                expected.append(decoder.decode_32bit_float())
+        expected = np.array(expected, dtype=FRAME_DTYPES[data_type].newbyteorder("="))
+        result = decode_frame(payload, data_type)
+        assert result.dtype == expected.dtype
+        if data_type == DataType.FLOAT32:
+            # Signalling NaNs get quieted on the float -> double -> float round
+            # trip through pymodbus, so compare NaN positions instead of bits
+            nan = np.isnan(expected)
+            assert np.array_equal(nan, np.isnan(result)), f"{data_type} NaN mismatch"
+            result, expected = result[~nan], expected[~nan]
+        assert result.tobytes() == expected.tobytes(), f"{data_type} mismatch"
+        logger.info(f"{data_type} decode matches pymodbus")
+    print("decode_frame matches pymodbus for UINT32 and FLOAT32")
@@ -0,0 +1,92 @@
+import threading
+from config import ConfigSingleton
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DSP_WORKER = ConfigSingleton().get_config()["DSP_WORKER"]
+
+
+class DSPWorker:
+    # Runs the charts' filtering and FFTs on one background thread so the Tk
+    # thread only draws. Every key (a chart) has a single job slot: a job
+    # submitted while the key's previous one is still waiting replaces it,
+    # so a slow window is never computed for data that is already stale.
+    # The Tk thread collects finished results with take(). The FFTs and IIR
+    # filters release the GIL while they run. With threaded=False jobs run
+    # inline in submit().
+    def __init__(self, threaded: bool = bool(DSP_WORKER)) -> None:
+        self.threaded = threaded
+        self.condition = threading.Condition()
+        # key -> (function, args), in submission order
+        self.pending = {}
+        self.results = {}
+        self.thread = None
+        self.running = True
+        self.jobs = 0
+        self.coalesced = 0
+
+    def submit(self, key, function, *args):
+        if not self.threaded:
+            self.results[key] = function(*args)
+            self.jobs += 1
+            return
+        with self.condition:
+            if not self.running:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="dsp worker")
+                self.thread.daemon = True
+                self.thread.start()
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = (function, args)
+            self.condition.notify()
+
+    def take(self, key):
+        # The key's latest result, or None if there is no new one
+        with self.condition:
+            return self.results.pop(key, None)
+
+    def cancel(self, key):
+        with self.condition:
+            self.pending.pop(key, None)
+            self.results.pop(key, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                key = next(iter(self.pending))
+                function, args = self.pending.pop(key)
+            try:
+                result = function(*args)
+            except Exception as e:
+                logger.error(f"DSP job for {key} failed: {e}")
+                continue
+            with self.condition:
+                self.results[key] = result
+                self.jobs += 1
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "jobs": self.jobs,
+                "coalesced": self.coalesced,
+                "pending": len(self.pending),
+            }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+
+dsp_worker = DSPWorker()
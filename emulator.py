@@ -0,0 +1,221 @@
+import os
+import pty
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+import numpy as np
+from pymodbus.utilities import checkCRC, computeCRC
+from config import ConfigSingleton
+from data_api import DataType, calculate_crc, custom_frame_length, encode_frame
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SLAVE_ID = ConfigSingleton().get_config()["SLAVE_ID"]
+BAUDRATE = ConfigSingleton().get_config()["BAUDRATE"]
+READ_SIN_DATA_CMD = ConfigSingleton().get_config()["READ_SIN_DATA_CMD"]
+READ_DDS_DATA_CMD = ConfigSingleton().get_config()["READ_DDS_DATA_CMD"]
+CUSTOM_PROTOCO_DATA_BYTE_COUNT = ConfigSingleton().get_config()[
+    "CUSTOM_PROTOCO_DATA_BYTE_COUNT"
+]
+DATA_FREQUENCY = ConfigSingleton().get_config()["DATA_FREQUENCY"]
+INDICATOR_REGISTERS = {
+    ConfigSingleton().get_config()[address]: ConfigSingleton().get_config()[value]
+    for address, value in [
+        ("TEMP_STABLE_INDICATOR_ADDRESS", "TEMP_STABLE_INDICATOR_VALUE"),
+        ("LASER_CURRENT_LOCK_ADDRESS", "LASER_CURRENT_LOCK_VALUE"),
+        ("RADIO_LOCK_ADDRESS", "RADIO_LOCK_VALUE"),
+    ]
+}
+
+CUSTOM_PROTOCOL_START = 0xAB
+CUSTOM_COMMAND_LENGTH = 9
+MODBUS_REQUEST_LENGTH = 8
+
+
+class DeviceEmulator:
+    # Emulates the sensor on a pseudo terminal: replies to the custom
+    # READ_SIN_DATA_CMD/READ_DDS_DATA_CMD commands with framed data and serves
+    # holding registers over Modbus RTU (function codes 3 and 6). Linux only.
+    def __init__(
+        self,
+        latency: float = 0.0,
+        baudrate: int = BAUDRATE,
+        error_rate: float = 0.0,
+        registers: dict = None,
+        slave_id: int = SLAVE_ID,
+    ) -> None:
+        self.latency = latency
+        # Replies are paced at this baud rate, 0 sends them immediately
+        self.baudrate = baudrate
+        # Probability of dropping, corrupting or truncating a reply
+        self.error_rate = error_rate
+        self.registers = dict(INDICATOR_REGISTERS if registers is None else registers)
+        self.slave_id = slave_id
+
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self.commands = {
+            bytes.fromhex(READ_SIN_DATA_CMD): DataType.FLOAT32,
+            bytes.fromhex(READ_DDS_DATA_CMD): DataType.UINT32,
+        }
+        # Each channel streams its own samples
+        self.sample_index = {data_type: 0 for data_type in self.commands.values()}
+        self.frame_count = 0
+        self.modbus_count = 0
+        self.error_count = 0
+
+        self.stop_flag = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.thread.start()
+        logger.info(f"Device emulator listening on {self.port}")
+        return self.port
+
+    def stop(self):
+        self.stop_flag.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def make_samples(self, data_type: DataType, count: int):
+        index = self.sample_index[data_type] + np.arange(count)
+        self.sample_index[data_type] += count
+        if data_type == DataType.UINT32:
+            # DDS sweep counter
+            return index.astype(np.uint32)
+        t = index / DATA_FREQUENCY
+        return (
+            np.sin(2 * np.pi * 5 * t)
+            + 0.5 * np.sin(2 * np.pi * 50 * t)
+            + np.random.normal(0, 0.5, count)
+        ).astype(np.float32)
+
+    def custom_reply(self, command: bytes) -> bytes:
+        data_type = self.commands.get(command)
+        if data_type is None:
+            logger.warning(f"Emulator got unknown command {command.hex()}")
+            return b""
+        self.frame_count += 1
+        samples = self.make_samples(data_type, CUSTOM_PROTOCO_DATA_BYTE_COUNT // 4)
+        reply = (
+            command[:3]
+            + struct.pack(">H", CUSTOM_PROTOCO_DATA_BYTE_COUNT)
+            + encode_frame(samples, data_type)
+        )
+        # Pad to the frame length, the last two bytes are the CRC
+        reply = reply.ljust(custom_frame_length() - 2, b"\0")
+        # CRC low byte first, like the commands
+        return reply + struct.pack("<H", calculate_crc(reply))
+
+    def modbus_reply(self, request: bytes) -> bytes:
+        self.modbus_count += 1
+        unit, function_code, address, value = struct.unpack(">BBHH", request[:6])
+        if function_code == 3:
+            values = [self.registers.get(address + i, 0) for i in range(value)]
+            reply = struct.pack(
+                f">BBB{value}H", unit, function_code, 2 * value, *values
+            )
+        elif function_code == 6:
+            self.registers[address] = value
+            reply = request[:6]
+        else:
+            # Illegal function exception
+            reply = struct.pack(">BBB", unit, function_code | 0x80, 1)
+        return reply + struct.pack(">H", computeCRC(reply))
+
+    def inject_error(self, reply: bytes) -> bytes:
+        if not reply or random.random() >= self.error_rate:
+            return reply
+        self.error_count += 1
+        error = random.choice(["drop", "corrupt", "truncate"])
+        logger.info(f"Emulator injecting {error} error")
+        if error == "drop":
+            return b""
+        if error == "truncate":
+            return reply[: random.randrange(len(reply))]
+        position = random.randrange(len(reply))
+        return (
+            reply[:position] + bytes([reply[position] ^ 0xFF]) + reply[position + 1 :]
+        )
+
+    def handle(self, buffer: bytearray) -> bytes:
+        # Consumes one complete request from buffer and returns the reply,
+        # returns None when more bytes are needed
+        if buffer[0] == CUSTOM_PROTOCOL_START:
+            if len(buffer) < CUSTOM_COMMAND_LENGTH:
+                return None
+            command = bytes(buffer[:CUSTOM_COMMAND_LENGTH])
+            del buffer[:CUSTOM_COMMAND_LENGTH]
+            return self.custom_reply(command)
+        if buffer[0] == self.slave_id:
+            if len(buffer) < MODBUS_REQUEST_LENGTH:
+                return None
+            request = bytes(buffer[:MODBUS_REQUEST_LENGTH])
+            if checkCRC(request[:-2], struct.unpack(">H", request[-2:])[0]):
+                del buffer[:MODBUS_REQUEST_LENGTH]
+                return self.modbus_reply(request)
+        # Not a request start, drop a byte to resynchronise
+        del buffer[:1]
+        return b""
+
+    def send(self, reply: bytes):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.baudrate:
+            # 10 bits per byte with 8N1
+            time.sleep(len(reply) * 10 / self.baudrate)
+        os.write(self.master_fd, reply)
+
+    def run(self):
+        buffer = bytearray()
+        while not self.stop_flag.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                buffer.extend(os.read(self.master_fd, 4096))
+            except OSError:
+                break
+            while buffer:
+                reply = self.handle(buffer)
+                if reply is None:
+                    break
+                reply = self.inject_error(reply)
+                if reply:
+                    self.send(reply)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0
+    error_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    with DeviceEmulator(latency=latency, error_rate=error_rate) as emulator:
+        print(f'Set DEVICE_PORT: "{emulator.port}" and FAKE_CUSTOM_DATA: 0')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
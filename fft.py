@@ -1,5 +1,7 @@
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy.fft import next_fast_len, rfft, rfftfreq
+from scipy.signal import butter, get_window, sosfilt, sosfilt_zi
+from ring_buffer import RingBuffer
 
 import logging
 
@@ -17,6 +19,178 @@ def fft(data, fs):
     return (f[f >= 0], cali_fft[f >= 0])
 
 
+class Spectrum:
+    # Single-sided magnitude spectrum of a real signal. The frequency axis and
+    # window only depend on the input length, so they are rebuilt only when
+    # the length changes, and the input is zero padded to a fast FFT size.
+    def __init__(self, fs, window="hann") -> None:
+        self.fs = fs
+        self.window_name = window
+        self.length = None
+        self.n_fft = None
+        self.window = None
+        self.scale = None
+        self.f = None
+
+    def prepare(self, length):
+        if length == self.length:
+            return
+        self.length = length
+        self.n_fft = next_fast_len(length, real=True)
+        if self.window_name:
+            self.window = get_window(self.window_name, length)
+        else:
+            self.window = np.ones(length)
+        # Amplitude calibration, corrected for the window's coherent gain
+        self.scale = 2.0 / self.window.sum()
+        self.f = rfftfreq(self.n_fft, 1.0 / self.fs)
+
+    def compute(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        self.prepare(len(data))
+        magnitude = np.abs(rfft(data * self.window, n=self.n_fft)) * self.scale
+        return (self.f, magnitude)
+
+
+class StreamingSTFT:
+    # Short-time magnitude spectra in dB of a sample stream. process() only
+    # transforms the segments completed by the samples it is given, the last
+    # `history` spectra are kept as rows of a preallocated RingBuffer timed
+    # at their segment centres.
+    def __init__(
+        self, fs, segment_length=256, overlap=0.5, history=300, window="hann"
+    ) -> None:
+        self.fs = fs
+        self.segment_length = segment_length
+        self.hop = max(1, int(segment_length * (1 - overlap)))
+        self.window = get_window(window, segment_length)
+        # Same amplitude calibration as Spectrum
+        self.scale = 2.0 / self.window.sum()
+        self.f = rfftfreq(segment_length, 1.0 / fs)
+        self.spectra = RingBuffer(history, np.float32, (len(self.f),))
+        self.pending_times = np.zeros(0)
+        self.pending = np.zeros(0)
+
+    def reset(self):
+        self.spectra = RingBuffer(self.spectra.capacity, np.float32, (len(self.f),))
+        self.pending_times = np.zeros(0)
+        self.pending = np.zeros(0)
+
+    def process(self, times, data) -> int:
+        # Returns the number of new spectra. No segment spans a gap in the
+        # sample times (skipped frames, a paused channel or a restarted
+        # acquisition), the samples pending at a gap are dropped.
+        times = np.asarray(times, dtype=np.float64)
+        data = np.asarray(data, dtype=np.float64)
+        steps = np.diff(np.concatenate([self.pending_times[-1:], times]))
+        gaps = np.flatnonzero(np.abs(steps * self.fs - 1) > 0.5)
+        if not len(self.pending_times):
+            gaps += 1
+        bounds = [0, *gaps, len(times)]
+        new_spectra = 0
+        for i in range(len(bounds) - 1):
+            if i > 0:
+                self.pending_times = np.zeros(0)
+                self.pending = np.zeros(0)
+            new_spectra += self.process_run(
+                times[bounds[i] : bounds[i + 1]], data[bounds[i] : bounds[i + 1]]
+            )
+        return new_spectra
+
+    def process_run(self, times, data) -> int:
+        # Continuous samples following the pending ones
+        self.pending_times = np.concatenate([self.pending_times, times])
+        self.pending = np.concatenate([self.pending, data])
+        if len(self.pending) < self.segment_length:
+            return 0
+        count = (len(self.pending) - self.segment_length) // self.hop + 1
+        # Only the newest segments that fit in the history are transformed
+        skipped = max(count - self.spectra.capacity, 0)
+        starts = np.arange(skipped, count) * self.hop
+        segments = np.lib.stride_tricks.sliding_window_view(
+            self.pending, self.segment_length
+        )[starts]
+        magnitude = np.abs(rfft(segments * self.window, axis=1)) * self.scale
+        self.spectra.extend(
+            self.pending_times[starts + self.segment_length // 2],
+            20 * np.log10(magnitude + 1e-12),
+        )
+        self.pending_times = self.pending_times[count * self.hop :]
+        self.pending = self.pending[count * self.hop :]
+        return count - skipped
+
+
+def parse_cutoff(text):
+    try:
+        cutoff = float(text)
+    except (TypeError, ValueError):
+        return None
+    return cutoff if cutoff > 0 else None
+
+
+class StreamingFilter:
+    # Butterworth low/high/band-pass as second-order sections. The filter
+    # state is kept between calls so only newly arrived samples are filtered.
+    def __init__(self, fs, order=4) -> None:
+        self.fs = fs
+        self.order = order
+        self.cutoff_text = None
+        self.sos = None
+        self.zi = None
+
+    def set_cutoffs(self, lowpass_cutoff, highpass_cutoff):
+        # Returns True when the filter was redesigned and its state reset
+        if (lowpass_cutoff, highpass_cutoff) == self.cutoff_text:
+            return False
+        self.cutoff_text = (lowpass_cutoff, highpass_cutoff)
+
+        nyquist = self.fs / 2
+        lowpass = parse_cutoff(lowpass_cutoff)
+        highpass = parse_cutoff(highpass_cutoff)
+        if lowpass is not None and lowpass >= nyquist:
+            logger.warning(
+                f"Low-pass cutoff {lowpass} Hz ignored, must be below {nyquist} Hz"
+            )
+            lowpass = None
+        if highpass is not None and highpass >= nyquist:
+            logger.warning(
+                f"High-pass cutoff {highpass} Hz ignored, must be below {nyquist} Hz"
+            )
+            highpass = None
+
+        if lowpass is not None and highpass is not None and highpass < lowpass:
+            self.sos = butter(
+                self.order, [highpass, lowpass], "bandpass", fs=self.fs, output="sos"
+            )
+        elif lowpass is not None and highpass is not None:
+            # Pass band is empty, same as zeroing every bin with the FFT filter
+            self.sos = np.zeros((1, 6))
+            self.sos[0, 3] = 1
+        elif lowpass is not None:
+            self.sos = butter(self.order, lowpass, "lowpass", fs=self.fs, output="sos")
+        elif highpass is not None:
+            self.sos = butter(
+                self.order, highpass, "highpass", fs=self.fs, output="sos"
+            )
+        else:
+            self.sos = None
+        self.zi = None
+        return True
+
+    def reset(self):
+        self.zi = None
+
+    def process(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        if self.sos is None or len(data) == 0:
+            return data
+        if self.zi is None:
+            # Start in steady state for the first sample to avoid a step
+            self.zi = sosfilt_zi(self.sos) * data[0]
+        filtered, self.zi = sosfilt(self.sos, data, zi=self.zi)
+        return filtered
+
+
 def filter(data, fs, lowpass_cutoff, highpass_cutoff):
     fft = np.fft.fftshift(np.fft.fft(data))  # Shifted double-sided FFT
 
@@ -37,6 +211,8 @@ def filter(data, fs, lowpass_cutoff, highpass_cutoff):
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     # 生成示例信号
     fs = 1000  # 采样频率
     t = np.arange(0, 1, 1 / fs)  # 时间序列
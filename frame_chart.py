@@ -1,19 +1,129 @@
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.animation import FuncAnimation
 import customtkinter
 from custom_data import CustomData
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from config import ConfigSingleton
+from matplotlib.ticker import FuncFormatter
 
-from fft import filter, fft
+from fft import filter, Spectrum, StreamingFilter, StreamingSTFT
+from ring_buffer import RingBuffer
+from instrumentation import instrumentation
+from dsp_worker import dsp_worker
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 DATA_FREQUENCY = ConfigSingleton().get_config()["DATA_FREQUENCY"]
-DATA_PRINT_AVG_COUNT = ConfigSingleton().get_config()["DATA_FREQUENCY"]
+DATA_PRINT_AVG_COUNT = ConfigSingleton().get_config()["DATA_PRINT_AVG_COUNT"]
 CHART_REFRESH_RATE = ConfigSingleton().get_config()["CHART_REFRESH_RATE"]
+DISPLAY_TIME_RANGE = ConfigSingleton().get_config()["DISPLAY_TIME_RANGE"]
+FILTER_MODE = ConfigSingleton().get_config()["FILTER_MODE"]
+FILTER_ORDER = ConfigSingleton().get_config()["FILTER_ORDER"]
+CHART_RENDER_MODE = ConfigSingleton().get_config()["CHART_RENDER_MODE"]
+HISTORY_MAX_POINTS = ConfigSingleton().get_config()["HISTORY_MAX_POINTS"]
+SPECTROGRAM_SEGMENT_LENGTH = ConfigSingleton().get_config()[
+    "SPECTROGRAM_SEGMENT_LENGTH"
+]
+SPECTROGRAM_OVERLAP = ConfigSingleton().get_config()["SPECTROGRAM_OVERLAP"]
+SPECTROGRAM_HISTORY = ConfigSingleton().get_config()["SPECTROGRAM_HISTORY"]
+
+
+def decimate_minmax(x, y, bins):
+    # Keep the min and max of every bin, in order, so peaks survive and the
+    # line never has more than ~2 points per pixel
+    if bins <= 0 or len(y) <= 2 * bins:
+        return x, y
+    size = -(-len(y) // bins)
+    full = len(y) // size * size
+    blocks = y[:full].reshape(-1, size)
+    base = np.arange(0, full, size)
+    index = np.sort(
+        np.stack([base + blocks.argmin(axis=1), base + blocks.argmax(axis=1)], axis=1),
+        axis=1,
+    ).ravel()
+    index = np.concatenate([index, np.arange(full, len(y))])
+    return x[index], y[index]
+
+
+def expand_limits(limits, low, high, log=False):
+    # Returns new axis limits only when the data leaves the current ones or
+    # uses less than half of them, otherwise None
+    if log:
+        if high <= 0:
+            return None
+        low = max(low, high * 1e-12)
+        limits = None if limits is None else np.log10(limits)
+        low, high = np.log10(low), np.log10(high)
+    margin = (high - low) * 0.1 or abs(high) * 0.1 or 1
+    if (
+        limits is not None
+        and limits[0] <= low
+        and high <= limits[1]
+        and (high - low) >= (limits[1] - limits[0]) * 0.5
+    ):
+        return None
+    new_limits = (low - margin, high + margin)
+    return tuple(10 ** np.array(new_limits)) if log else new_limits
+
+
+class LineRenderer:
+    # Draws a single line either with a full canvas.draw() or, in blit mode,
+    # by restoring the cached background and redrawing only the line. Axes,
+    # ticks and the background are only redrawn when the limits change.
+    def __init__(self, canvas, ax, line) -> None:
+        self.canvas = canvas
+        self.ax = ax
+        self.line = line
+        self.blit = CHART_RENDER_MODE == "blit"
+        self.background = None
+        if self.blit:
+            self.line.set_animated(True)
+            self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.figure.bbox)
+        self.ax.draw_artist(self.line)
+
+    def is_visible(self):
+        return self.canvas.get_tk_widget().winfo_viewable()
+
+    def render(self, x, y, xlim=None, ylim=None):
+        if not self.blit:
+            self.line.set_data(x, y)
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.canvas.draw()
+            return
+        x, y = decimate_minmax(x, y, int(self.ax.bbox.width))
+        self.line.set_data(x, y)
+        if xlim is not None:
+            self.ax.set_xlim(xlim)
+        if ylim is not None:
+            self.ax.set_ylim(ylim)
+        if xlim is not None or ylim is not None or self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.ax.figure.bbox)
+
+
+class ImageRenderer(LineRenderer):
+    # LineRenderer for an AxesImage, only a change of color limits redraws
+    # the axes and colorbar
+    def render(self, data, clim=None):
+        self.line.set_data(data)
+        if clim is not None:
+            self.line.set_clim(clim)
+        if not self.blit or clim is not None or self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.ax.figure.bbox)
 
 
 class TimeChart:
@@ -26,7 +136,6 @@ class TimeChart:
     ):
         self.fig, self.ax = plt.subplots()
         (self.line,) = self.ax.plot([], [], lw=2, label="Time Series")
-        self.ax.set_ylabel("Value")
         self.master = master
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.master)
         self.canvas.draw()
@@ -35,11 +144,39 @@ class TimeChart:
         )
         self.custom_data = custome_data
 
+        # x values are seconds on the CustomData timebase, only the visible
+        # ticks get converted to wall clock labels
+        self.ax.xaxis.set_major_formatter(
+            FuncFormatter(
+                lambda x, pos: self.custom_data.get_timebase()
+                .to_datetime(x)
+                .strftime("%H:%M:%S")
+            )
+        )
+        self.ax.tick_params(axis="x", labelrotation=45)
+        self.ax.set_xlabel("Time")
+        self.ax.set_ylabel("Magnetic field strength (nt)")
+
         self.ax.relim()
         self.ax.autoscale_view()
 
         self.lowpass_cutoff_entry = lowpass_cutoff_entry
         self.highpass_cutoff_entry = highpass_cutoff_entry
+
+        self.streaming_filter = StreamingFilter(
+            DATA_FREQUENCY / DATA_PRINT_AVG_COUNT, FILTER_ORDER
+        )
+        self.filtered_data = None
+        self.filtered_mode = None
+        self.filtered_count = 0
+
+        self.renderer = LineRenderer(self.canvas, self.ax, self.line)
+        self.data_version = None
+        self.xlim = None
+        self.ylim = None
+        # Seconds shown, beyond DISPLAY_TIME_RANGE the chart shows history
+        self.time_range = DISPLAY_TIME_RANGE
+
         self.running = True
         self.update()
 
@@ -49,45 +186,125 @@ class TimeChart:
     def stop(self):
         self.running = False
         self.master.after_cancel(self.schedule_id)
-        plt.close()
+        dsp_worker.cancel(self)
+        plt.close(self.fig)
+
+    def get_streaming_filtered_data(self, lowpass_cutoff, highpass_cutoff):
+        redesigned = self.streaming_filter.set_cutoffs(lowpass_cutoff, highpass_cutoff)
+        if redesigned or self.filtered_data is None:
+            # Refilter the current window once with the new filter
+            self.filtered_data = RingBuffer(
+                int(DISPLAY_TIME_RANGE * DATA_FREQUENCY / DATA_PRINT_AVG_COUNT)
+            )
+            self.filtered_count = 0
+        data_mode, count, times, data = self.custom_data.get_new_processed_data(
+            self.filtered_count
+        )
+        if data_mode != self.filtered_mode:
+            self.filtered_mode = data_mode
+            self.filtered_data = RingBuffer(self.filtered_data.capacity)
+            self.streaming_filter.reset()
+            data_mode, count, times, data = self.custom_data.get_new_processed_data(0)
+        self.filtered_count = count
+        self.filtered_data.extend(times, self.streaming_filter.process(data))
+        # Copies, the next job writes over the ring buffer while these are drawn
+        times, filtered = self.filtered_data.latest()
+        return times.copy(), filtered.copy()
+
+    def set_time_range(self, seconds: float):
+        self.time_range = seconds
+        self.xlim = None
+        self.ylim = None
+        self.data_version = None
+
+    def get_history_data(self, time_range):
+        # Min/max envelope of the raw samples from the history level that
+        # fits HISTORY_MAX_POINTS, so any range costs about the same. The
+        # cutoff filters only apply to the live window.
+        data_mode, times, low, mean, high = self.custom_data.get_history(
+            time_range, HISTORY_MAX_POINTS
+        )
+        return np.repeat(times, 2), np.column_stack([low, high]).ravel()
+
+    def get_xlim(self, times):
+        # Page the x axis forward by 10% of the window at a time instead of
+        # moving it, and rescaling the ticks, on every refresh
+        if (
+            self.xlim is not None
+            and self.xlim[0] <= times[0]
+            and times[-1] <= self.xlim[1]
+        ):
+            return None
+        span = max(self.time_range, times[-1] - times[0])
+        self.xlim = (times[-1] - span, times[-1] + span * 0.1)
+        return self.xlim
 
     def update(self):
         if self.running:
             self.schedule_id = self.master.after(CHART_REFRESH_RATE, self.update)
-        prcessed_data = self.custom_data.get_processed_data()
-        if prcessed_data:
-            logger.info(f"Got processed data length: {len(prcessed_data)}")
-            times, data = zip(*prcessed_data)
-            filtered = filter(
-                data,
-                DATA_FREQUENCY / DATA_PRINT_AVG_COUNT,
-                self.lowpass_cutoff_entry.get(),
-                self.highpass_cutoff_entry.get(),
-            )
-            self.line.set_data(times, filtered)
-            # Format x-axis tick labels as time
-            time_format = "%H:%M:%S"
-            ticks = times[::100]
-            self.ax.set_xticks(ticks)
-            self.ax.set_xticklabels(
-                [dt.strftime(time_format) for dt in ticks],
-                rotation=45,
-                ha="right",
+        if not self.renderer.is_visible():
+            return
+        lowpass_cutoff = self.lowpass_cutoff_entry.get()
+        highpass_cutoff = self.highpass_cutoff_entry.get()
+        data_version = (
+            self.custom_data.get_data_version(),
+            lowpass_cutoff,
+            highpass_cutoff,
+            self.time_range,
+        )
+        if data_version != self.data_version:
+            self.data_version = data_version
+            dsp_worker.submit(
+                self, self.compute, lowpass_cutoff, highpass_cutoff, self.time_range
             )
-            self.ax.set_xlabel("Time")
-            self.ax.set_ylabel("Magnetic field strength (nt)")
 
-        self.ax.relim()
-        self.ax.autoscale_view()
-        if self.running:
-            self.canvas.draw()
+        result = dsp_worker.take(self)
+        if result is None:
+            return
+        time_range, times, filtered = result
+        # Drop a window computed before the time range was changed
+        if len(filtered) and self.running and time_range == self.time_range:
+            logger.info(f"Got processed data length: {len(filtered)}")
+            ylim = expand_limits(self.ylim, filtered.min(), filtered.max())
+            if ylim is not None:
+                self.ylim = ylim
+            start = instrumentation.now()
+            self.renderer.render(times, filtered, self.get_xlim(times), ylim)
+            instrumentation.record("render.time_chart", start)
+
+    def compute(self, lowpass_cutoff, highpass_cutoff, time_range):
+        # Runs on the DSP worker, the only thread touching the filter state
+        start = instrumentation.now()
+        if time_range > DISPLAY_TIME_RANGE:
+            times, filtered = self.get_history_data(time_range)
+        elif FILTER_MODE == "streaming":
+            times, filtered = self.get_streaming_filtered_data(
+                lowpass_cutoff, highpass_cutoff
+            )
+        else:
+            times, data = self.custom_data.get_processed_data()
+            filtered = (
+                np.real(
+                    filter(
+                        data,
+                        DATA_FREQUENCY / DATA_PRINT_AVG_COUNT,
+                        lowpass_cutoff,
+                        highpass_cutoff,
+                    )
+                )
+                if len(data)
+                else data
+            )
+        instrumentation.record("dsp.time_chart", start)
+        return time_range, times, filtered
 
 
 class FFTChart:
     def __init__(self, custome_data: CustomData, master: customtkinter.CTkFrame):
         self.fig, self.ax = plt.subplots()
         (self.line,) = self.ax.loglog([], [])
-        self.ax.set_ylabel("Value")
+        self.ax.set_xlabel("Frequency (Hz)")
+        self.ax.set_ylabel("Magnitude")
         self.master = master
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.master)
         self.canvas.draw()
@@ -99,31 +316,164 @@ class FFTChart:
         self.ax.relim()
         self.ax.autoscale_view()
 
+        self.spectrum = Spectrum(DATA_FREQUENCY)
+        self.renderer = LineRenderer(self.canvas, self.ax, self.line)
+        self.data_version = None
+        self.xlim = None
+        self.ylim = None
+
         self.running = True
 
         self.update()
 
     def __del__(self):
         self.stop()
-        plt.close()
 
     def stop(self):
         self.running = False
         self.master.after_cancel(self.schedule_id)
+        dsp_worker.cancel(self)
+        plt.close(self.fig)
 
     def update(self):
         if self.running:
             self.schedule_id = self.master.after(CHART_REFRESH_RATE, self.update)
-        data = self.custom_data.get_original_data()
-        if data:
-            times, raw_data = zip(*data)
-            f, fft_data = fft(raw_data, DATA_FREQUENCY)
+        if not self.renderer.is_visible():
+            return
+        # Only recompute and redraw when a new frame has arrived
+        data_version = self.custom_data.get_data_version()
+        if data_version != self.data_version:
+            self.data_version = data_version
+            dsp_worker.submit(self, self.compute)
 
-            self.line.set_data(f, fft_data)
-            self.ax.set_xlabel("Frequency (Hz)")
-            self.ax.set_ylabel("Magnitude")
+        result = dsp_worker.take(self)
+        if result is None or not self.running:
+            return
+        f, fft_data = result
+        xlim = None
+        if self.xlim != (f[0], f[-1]):
+            xlim = self.xlim = (f[0], f[-1])
+        ylim = expand_limits(self.ylim, fft_data.min(), fft_data.max(), log=True)
+        if ylim is not None:
+            self.ylim = ylim
+        start = instrumentation.now()
+        self.renderer.render(f, fft_data, xlim, ylim)
+        instrumentation.record("render.fft_chart", start)
 
-        self.ax.relim()
-        self.ax.autoscale_view()
+    def compute(self):
+        # Runs on the DSP worker, None when there is nothing to draw
+        times, raw_data = self.custom_data.get_original_data()
+        if not len(raw_data):
+            return None
+        start = instrumentation.now()
+        f, fft_data = self.spectrum.compute(raw_data)
+        instrumentation.record("dsp.fft_chart", start)
+        if len(f) < 3:
+            return None
+        # The log x axis can't show the DC bin
+        return f[1:], fft_data[1:]
+
+
+class SpectrogramChart:
+    # Waterfall of short-time spectra of the raw samples, newest at the top.
+    # Each refresh transforms only the samples that arrived since the last
+    # one and scrolls the fixed-size image.
+    def __init__(self, custome_data: CustomData, master: customtkinter.CTkFrame):
+        self.fig, self.ax = plt.subplots()
+        self.custom_data = custome_data
+        self.stft = StreamingSTFT(
+            DATA_FREQUENCY,
+            SPECTROGRAM_SEGMENT_LENGTH,
+            SPECTROGRAM_OVERLAP,
+            SPECTROGRAM_HISTORY,
+        )
+        # Rows not filled yet are NaN and left blank
+        self.image_data = np.full(
+            (SPECTROGRAM_HISTORY, len(self.stft.f)), np.nan, dtype=np.float32
+        )
+        history_seconds = SPECTROGRAM_HISTORY * self.stft.hop / DATA_FREQUENCY
+        self.image = self.ax.imshow(
+            self.image_data,
+            aspect="auto",
+            origin="lower",
+            interpolation="nearest",
+            extent=(self.stft.f[0], self.stft.f[-1], -history_seconds, 0),
+        )
+        self.fig.colorbar(self.image, ax=self.ax, label="dB")
+        self.ax.set_xlabel("Frequency (Hz)")
+        self.ax.set_ylabel("Time (s)")
+        self.master = master
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.master)
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack(
+            side=customtkinter.TOP, fill=customtkinter.BOTH, expand=1
+        )
+
+        self.renderer = ImageRenderer(self.canvas, self.ax, self.image)
+        self.data_version = None
+        self.data_mode = None
+        self.count = 0
+        self.clim = None
+
+        self.running = True
+        self.update()
+
+    def __del__(self):
+        self.stop()
+
+    def stop(self):
+        self.running = False
+        self.master.after_cancel(self.schedule_id)
+        dsp_worker.cancel(self)
+        plt.close(self.fig)
+
+    def update(self):
         if self.running:
-            self.canvas.draw()
+            self.schedule_id = self.master.after(CHART_REFRESH_RATE, self.update)
+        if not self.renderer.is_visible():
+            return
+        if self.custom_data.get_data_version() != self.data_version:
+            self.data_version = self.custom_data.get_data_version()
+            dsp_worker.submit(self, self.compute)
+
+        result = dsp_worker.take(self)
+        if result is None or not self.running:
+            return
+        image_data, low, high = result
+        clim = expand_limits(self.clim, low, high)
+        if clim is not None:
+            self.clim = clim
+        start = instrumentation.now()
+        self.renderer.render(image_data, clim)
+        instrumentation.record("render.spectrogram_chart", start)
+
+    def compute(self):
+        # Runs on the DSP worker, the only thread touching the STFT state.
+        # Returns a copy of the image and the new rows' color range, or None
+        # when no spectrum was completed.
+        data_mode, count, times, data = self.custom_data.get_new_original_data(
+            self.count
+        )
+        if data_mode != self.data_mode:
+            self.data_mode = data_mode
+            self.stft.reset()
+            self.image_data[:] = np.nan
+            data_mode, count, times, data = self.custom_data.get_new_original_data(0)
+        self.count = count
+        start = instrumentation.now()
+        new_spectra = self.stft.process(times, data)
+        if not new_spectra:
+            instrumentation.record("dsp.spectrogram_chart", start)
+            return None
+
+        times, spectra = self.stft.spectra.latest()
+        if len(spectra) == SPECTROGRAM_HISTORY:
+            image_data = spectra.copy()
+        else:
+            self.image_data[-len(spectra) :] = spectra
+            image_data = self.image_data.copy()
+        # Color limits follow the new rows only, so the cost doesn't grow
+        # with the history shown
+        low, high = np.percentile(spectra[-new_spectra:], [5, 100])
+        instrumentation.record("dsp.spectrogram_chart", start)
+        return image_data, low, high
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from enum import Enum
+from collections import deque
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy(Enum):
+    # What put() does when the queue is full
+    BLOCK = "block"  # wait for the consumer to make room
+    DROP_OLDEST = "drop_oldest"  # discard the oldest queued frame
+    DROP_NEWEST = "drop_newest"  # discard the frame being put
+
+
+class FrameQueue:
+    # Bounded hand-off from the acquisition thread to the processor. The
+    # consumer blocks in get_all() until something arrives and then takes
+    # everything pending in one batch. Frames lost to the overflow policy are
+    # counted instead of disappearing silently.
+    def __init__(
+        self,
+        capacity: int,
+        policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        name: str = "frames",
+    ) -> None:
+        self.capacity = capacity
+        self.policy = policy
+        self.name = name
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.put_count = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.block_time = 0.0
+        # Dropped count when the current run of drops started, None while
+        # nothing is being dropped
+        self.dropping_since = None
+
+    def put(self, item) -> bool:
+        # Returns False when item was not queued (dropped or queue closed)
+        with self.condition:
+            if self.closed:
+                return False
+            self.put_count += 1
+            if len(self.items) >= self.capacity:
+                if self.policy == OverflowPolicy.BLOCK:
+                    start = time.monotonic()
+                    while len(self.items) >= self.capacity and not self.closed:
+                        self.condition.wait()
+                    self.block_time += time.monotonic() - start
+                    if self.closed:
+                        return False
+                elif self.policy == OverflowPolicy.DROP_OLDEST:
+                    self.items.popleft()
+                    self.on_drop()
+                else:
+                    self.on_drop()
+                    return False
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.condition.notify_all()
+            return True
+
+    def on_drop(self):
+        if self.dropping_since is None:
+            self.dropping_since = self.dropped
+            logger.warning(
+                f"{self.name} queue full ({self.capacity}), dropping frames "
+                f"({self.policy.value})"
+            )
+        self.dropped += 1
+
+    def get_all(self, timeout: float = None) -> list:
+        # Waits until at least one item is queued (or timeout/close) and
+        # returns every queued item, oldest first
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            items = list(self.items)
+            self.items.clear()
+            if items:
+                self.condition.notify_all()
+            if self.dropping_since is not None:
+                logger.warning(
+                    f"{self.name} queue caught up after dropping "
+                    f"{self.dropped - self.dropping_since} frames"
+                )
+                self.dropping_since = None
+            return items
+
+    def close(self):
+        # Wakes every waiting producer and consumer, later puts are refused
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "length": len(self.items),
+                "capacity": self.capacity,
+                "policy": self.policy.value,
+                "frames": self.put_count,
+                "dropped": self.dropped,
+                "high_water": self.high_water,
+                "block_time_ms": self.block_time * 1000,
+            }
@@ -0,0 +1,130 @@
+import argparse
+import signal
+import threading
+import time
+from config import ConfigSingleton
+from connect import connect_device
+from bus import Bus
+from custom_data import CustomData, DataMode
+from indicator import Indicator
+from publisher import start_publisher
+from instrumentation import instrumentation
+from scheduler import Scheduler
+from logging_setup import setup_logging
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEVICE_PORT = ConfigSingleton().get_config()["DEVICE_PORT"]
+ACQUISITION_STATS_INTERVAL = ConfigSingleton().get_config()[
+    "ACQUISITION_STATS_INTERVAL"
+]
+
+
+# Unattended capture: the acquisition, processing and recording of app.py
+# without Tk or matplotlib. Stops on SIGINT/SIGTERM (or after --duration)
+# and closes the recordings before exiting.
+
+
+def format_stats(custom_data: CustomData, bus: Bus, indicator: Indicator) -> str:
+    stats = custom_data.get_stats()
+    channels = ", ".join(
+        f"{name} {channel['frame_rate']:.1f} frames/s "
+        f"{channel['sample_rate']:.0f} samples/s "
+        f"({channel['failed_reads']} failed)"
+        for name, channel in stats["channels"].items()
+        if channel["frames"] or channel["failed_reads"]
+    )
+    acquisition = stats["acquisition"]
+    frame_queue = stats["frame_queue"]
+    return (
+        f"{channels or 'no frames'} | "
+        f"deadline misses {acquisition['deadline_misses']}, "
+        f"skipped {acquisition['skipped_frames']} | "
+        f"queue dropped {frame_queue['dropped']}, "
+        f"high water {frame_queue['high_water']}/{frame_queue['capacity']} | "
+        f"bus {bus.get_stats()['utilization']:.0%} | "
+        f"temp {indicator.temp_on} laser {indicator.laser_on} "
+        f"radio {indicator.radio_on}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acquire and record without the UI")
+    parser.add_argument(
+        "--mode",
+        choices=[data_mode.name.lower() for data_mode in DataMode],
+        default=DataMode.SIN.name.lower(),
+        help="channels to acquire",
+    )
+    parser.add_argument(
+        "--no-record", action="store_true", help="acquire without recording"
+    )
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=ACQUISITION_STATS_INTERVAL,
+        help="seconds between stats lines",
+    )
+    parser.add_argument("--port", default=DEVICE_PORT, help="overrides DEVICE_PORT")
+    parser.add_argument(
+        "--stats-file",
+        help="append a JSON line of pipeline stage timings every stats interval",
+    )
+    args = parser.parse_args()
+
+    # Console only, through the same non-blocking queue as the app
+    setup_logging(logging.WARNING, log_file=None)
+
+    stop_event = threading.Event()
+
+    def on_signal(signum, frame):
+        logger.warning(f"Got signal {signum}, stopping")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    client, emulator = connect_device(args.port)
+    bus = Bus(client)
+    scheduler = Scheduler()
+    indicator = Indicator(bus, scheduler.get_scheduler())
+    publisher = start_publisher()
+    custom_data = CustomData(bus, publisher=publisher)
+    try:
+        custom_data.set_download(not args.no_record)
+        custom_data.set_mode(DataMode[args.mode.upper()])
+        print(f"Acquiring {args.mode} from {client.port}", flush=True)
+
+        end_time = time.monotonic() + args.duration if args.duration else None
+        while not stop_event.is_set():
+            timeout = args.stats_interval
+            if end_time is not None:
+                timeout = min(timeout, end_time - time.monotonic())
+                if timeout <= 0:
+                    break
+            if not stop_event.wait(timeout):
+                print(format_stats(custom_data, bus, indicator), flush=True)
+                if args.stats_file:
+                    instrumentation.dump(args.stats_file)
+    finally:
+        # Stopping CustomData drains the frame queue and closes the recorders
+        custom_data.stop()
+        if publisher is not None:
+            publisher.stop()
+        indicator.stop()
+        scheduler.stop()
+        bus.stop()
+        client.close()
+        if emulator is not None:
+            emulator.stop()
+        print(f"Stopped: {custom_data.get_stats()}", flush=True)
+        if args.stats_file:
+            instrumentation.dump(args.stats_file)
+        print(instrumentation.format(), flush=True)
+
+
+if __name__ == "__main__":
+    main()
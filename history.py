@@ -0,0 +1,89 @@
+import numpy as np
+from ring_buffer import RingBuffer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Columns of a history row
+MIN, MEAN, MAX = 0, 1, 2
+
+
+class HistoryLevel:
+    # Rows of (min, mean, max) over blocks of `factor` samples, timed at the
+    # block's first sample
+    def __init__(self, factor: int, seconds: float, sample_rate: float) -> None:
+        self.factor = factor
+        self.sample_rate = sample_rate / factor
+        self.buffer = RingBuffer(max(int(seconds * self.sample_rate), 1), shape=(3,))
+        self.pending_times = np.zeros(0)
+        self.pending = np.zeros((0, 3))
+
+    def seconds(self) -> float:
+        return self.buffer.capacity / self.sample_rate
+
+    def add(self, times: np.ndarray, rows: np.ndarray, step: int):
+        # rows come from the level below, `step` of them make one row here.
+        # Returns the completed rows for the next level.
+        if len(self.pending):
+            times = np.concatenate([self.pending_times, times])
+            rows = np.concatenate([self.pending, rows])
+        complete = len(rows) // step * step
+        self.pending_times = times[complete:]
+        self.pending = rows[complete:]
+        if complete == 0:
+            return times[:0], rows[:0]
+        blocks = rows[:complete].reshape(-1, step, 3)
+        new_rows = np.stack(
+            [
+                blocks[:, :, MIN].min(axis=1),
+                blocks[:, :, MEAN].mean(axis=1),
+                blocks[:, :, MAX].max(axis=1),
+            ],
+            axis=1,
+        )
+        new_times = times[:complete:step]
+        self.buffer.extend(new_times, new_rows)
+        return new_times, new_rows
+
+
+class TieredHistory:
+    # Progressively downsampled copies of a sample stream for long time
+    # ranges. Each level is built from the completed rows of the one below,
+    # so extend() costs about the same whatever the history length. Full-rate
+    # samples are not kept here, the live window already holds them.
+    def __init__(self, sample_rate: float, levels) -> None:
+        # levels is a list of (factor, seconds kept), each factor a multiple
+        # of the previous one
+        self.sample_rate = sample_rate
+        self.levels = []
+        previous_factor = 1
+        for factor, seconds in sorted(levels):
+            assert factor % previous_factor == 0, "History factors must divide"
+            self.levels.append(HistoryLevel(factor, seconds, sample_rate))
+            previous_factor = factor
+
+    def extend(self, times, values):
+        values = np.asarray(values, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+        rows = np.repeat(values[:, None], 3, axis=1)
+        previous_factor = 1
+        for level in self.levels:
+            times, rows = level.add(times, rows, level.factor // previous_factor)
+            previous_factor = level.factor
+            if len(rows) == 0:
+                break
+
+    def select(self, seconds: float, max_points: int) -> HistoryLevel:
+        # Finest level that shows `seconds` in at most max_points rows and
+        # keeps that much history, else the coarsest
+        for level in self.levels:
+            if seconds * level.sample_rate <= max_points and level.seconds() >= seconds:
+                return level
+        return self.levels[-1]
+
+    def latest(self, seconds: float, max_points: int):
+        # Returns (times, rows) of the last `seconds` at the selected level,
+        # rows are (min, mean, max). The arrays are read-only views.
+        level = self.select(seconds, max_points)
+        return level.buffer.latest(int(np.ceil(seconds * level.sample_rate)))
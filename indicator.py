@@ -1,8 +1,8 @@
-import customtkinter
 import sched
 from config import ConfigSingleton
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-from data_api import read_modbus, DataType
+from bus import Bus
+from data_api import DataType
+from register_poller import RegisterPoller
 
 import logging
 
@@ -21,19 +21,34 @@ TEMP_STABLE_INDICATOR_VALUE = ConfigSingleton().get_config()[
 ]
 LASER_CURRENT_LOCK_VALUE = ConfigSingleton().get_config()["LASER_CURRENT_LOCK_VALUE"]
 RADIO_LOCK_VALUE = ConfigSingleton().get_config()["RADIO_LOCK_VALUE"]
+INDICATOR_CACHE_TTL_MS = ConfigSingleton().get_config()["INDICATOR_CACHE_TTL_MS"]
+MODBUS_MAX_REGISTER_GAP = ConfigSingleton().get_config()["MODBUS_MAX_REGISTER_GAP"]
+
+INDICATOR_REGISTERS = {
+    "temp": (TEMP_STABLE_INDICATOR_ADDRESS, DataType.UINT16),
+    "laser": (LASER_CURRENT_LOCK_ADDRESS, DataType.UINT16),
+    "radio": (RADIO_LOCK_ADDRESS, DataType.UINT16),
+}
 
 
 class Indicator:
     def __init__(
         self,
-        modbus_client: ModbusClient,
+        bus: Bus,
         scheduler: sched.scheduler,
-        app: customtkinter.CTk,
-        temp_label,
-        laser_label,
-        radio_label,
+        app=None,
+        temp_label=None,
+        laser_label=None,
+        radio_label=None,
     ) -> None:
-        self.client = modbus_client
+        # app and the labels are Tk widgets, without them (headless) only the
+        # *_on states are kept up to date
+        self.poller = RegisterPoller(
+            bus,
+            INDICATOR_REGISTERS,
+            INDICATOR_CACHE_TTL_MS / 1000,
+            MODBUS_MAX_REGISTER_GAP,
+        )
         self.scheduler = scheduler
         self.app = app
         self.temp_label = temp_label
@@ -51,7 +66,8 @@ class Indicator:
         self.ui_event = None
 
         self.refresh()
-        self.refresh_ui()
+        if self.app is not None:
+            self.refresh_ui()
 
     def __del__(self):
         self.stop()
@@ -79,32 +95,10 @@ class Indicator:
         self,
     ) -> None:
         try:
-            self.temp_on = (
-                read_modbus(
-                    self.client,
-                    TEMP_STABLE_INDICATOR_ADDRESS,
-                    data_type=DataType.UINT16,
-                )
-                == TEMP_STABLE_INDICATOR_VALUE
-            )
-
-            self.laser_on = (
-                read_modbus(
-                    self.client,
-                    LASER_CURRENT_LOCK_ADDRESS,
-                    data_type=DataType.UINT16,
-                )
-                == LASER_CURRENT_LOCK_VALUE
-            )
-
-            self.radio_on = (
-                read_modbus(
-                    self.client,
-                    RADIO_LOCK_ADDRESS,
-                    data_type=DataType.UINT16,
-                )
-                == RADIO_LOCK_VALUE
-            )
+            values = self.poller.get_values()
+            self.temp_on = values["temp"] == TEMP_STABLE_INDICATOR_VALUE
+            self.laser_on = values["laser"] == LASER_CURRENT_LOCK_VALUE
+            self.radio_on = values["radio"] == RADIO_LOCK_VALUE
         except:
             logger.info(f"Exception when reading indicator data")
 
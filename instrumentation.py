@@ -0,0 +1,167 @@
+import bisect
+import json
+import threading
+import time
+from config import ConfigSingleton
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTATION = ConfigSingleton().get_config()["INSTRUMENTATION"]
+INSTRUMENTATION_DUMP_FILE = ConfigSingleton().get_config()["INSTRUMENTATION_DUMP_FILE"]
+
+# Histogram bucket upper bounds in seconds, 10 per decade from 1 us to 100 s
+BUCKET_BOUNDS = [10 ** (exponent / 10) for exponent in range(-60, 21)]
+# Counter rates are measured over windows of at least this many seconds
+RATE_WINDOW = 1.0
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the percentile, within ~26%
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS + [self.max], self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "min_ms": self.min * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.total = 0
+        self.window_start = time.monotonic()
+        self.window_total = 0
+        self.rate = 0.0
+
+    def add(self, amount, now: float):
+        self.total += amount
+        self.window_total += amount
+        if now - self.window_start >= RATE_WINDOW:
+            self.rate = self.window_total / (now - self.window_start)
+            self.window_start = now
+            self.window_total = 0
+
+    def snapshot(self, now: float):
+        elapsed = now - self.window_start
+        rate = self.rate
+        if elapsed >= 2 * RATE_WINDOW:
+            # Nothing counted for a while, the last window is stale
+            rate = self.window_total / elapsed
+        return {"total": self.total, "rate": rate}
+
+
+class Instrumentation:
+    # Per-stage timing histograms and throughput counters shared by every
+    # thread. When disabled, now() and record() return immediately so the
+    # instrumented code pays for two function calls.
+    def __init__(self, enabled: bool = bool(INSTRUMENTATION)) -> None:
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.histograms = {}
+        self.counters = {}
+
+    def now(self) -> float:
+        return time.perf_counter() if self.enabled else 0.0
+
+    def record(self, stage: str, start: float, end: float = None):
+        # Records the time since `start`, a value returned by now()
+        if not self.enabled:
+            return
+        seconds = (time.perf_counter() if end is None else end) - start
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(seconds)
+
+    def count(self, name: str, amount=1):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters.get(name)
+            if counter is None:
+                counter = self.counters[name] = Counter()
+            counter.add(amount, now)
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.histograms = {}
+            self.counters = {}
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "time": time.time(),
+                "start_time": self.start_time,
+                "stages": {
+                    stage: histogram.snapshot()
+                    for stage, histogram in sorted(self.histograms.items())
+                },
+                "counters": {
+                    name: counter.snapshot(now)
+                    for name, counter in sorted(self.counters.items())
+                },
+            }
+
+    def format(self) -> str:
+        # Plain text table for the stats panel
+        snapshot = self.snapshot()
+        if not self.enabled:
+            return "Instrumentation is disabled (INSTRUMENTATION: 0)"
+        lines = [
+            f"{'stage':<24}{'count':>8}{'mean':>9}{'p50':>9}{'p99':>9}{'max':>9}  ms"
+        ]
+        for stage, stats in snapshot["stages"].items():
+            if stats["count"]:
+                lines.append(
+                    f"{stage:<24}{stats['count']:>8}{stats['mean_ms']:>9.3f}"
+                    f"{stats['p50_ms']:>9.3f}{stats['p99_ms']:>9.3f}"
+                    f"{stats['max_ms']:>9.3f}"
+                )
+        lines.append("")
+        lines.append(f"{'counter':<24}{'total':>12}{'per second':>14}")
+        for name, stats in snapshot["counters"].items():
+            lines.append(f"{name:<24}{stats['total']:>12}{stats['rate']:>14.1f}")
+        return "\n".join(lines)
+
+    def dump(self, path: str = INSTRUMENTATION_DUMP_FILE):
+        # Appends one JSON line with the current snapshot
+        with open(path, "a") as file:
+            file.write(json.dumps(self.snapshot()) + "\n")
+        logger.info(f"Instrumentation dumped to {path}")
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,154 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from config import ConfigSingleton
+
+LOG_LEVEL = ConfigSingleton().get_config()["LOG_LEVEL"]
+LOG_FILE = ConfigSingleton().get_config()["LOG_FILE"]
+LOG_QUEUE_SIZE = ConfigSingleton().get_config()["LOG_QUEUE_SIZE"]
+LOG_RATE_LIMIT = ConfigSingleton().get_config()["LOG_RATE_LIMIT"]
+LOG_RATE_LIMITS = ConfigSingleton().get_config()["LOG_RATE_LIMITS"]
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+class RateLimitFilter(logging.Filter):
+    # Lets one record per call site (logger, line) through every `interval`
+    # seconds and counts the rest, the next record let through says how many
+    # were suppressed. Intervals come from LOG_RATE_LIMITS by logger name,
+    # else LOG_RATE_LIMIT, 0 lets everything through. Only DEBUG and INFO
+    # records are limited, warnings and errors always get through.
+    def __init__(self, default: float = LOG_RATE_LIMIT, limits=None) -> None:
+        super().__init__()
+        self.default = default
+        self.limits = dict(LOG_RATE_LIMITS if limits is None else limits)
+        self.lock = threading.Lock()
+        # (name, lineno) -> [interval, last time let through, suppressed]
+        self.call_sites = {}
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            call_site = self.call_sites.get(key)
+            if call_site is None:
+                interval = self.limits.get(record.name, self.default)
+                call_site = self.call_sites[key] = [interval, None, 0]
+            interval, last_time, suppressed = call_site
+            if not interval:
+                return True
+            if last_time is not None and now - last_time < interval:
+                call_site[2] += 1
+                self.suppressed += 1
+                return False
+            call_site[1] = now
+            call_site[2] = 0
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar suppressed)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the logging thread: records are handed over unformatted
+    # and dropped when the queue is full
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord):
+        # The listener runs in this process, so the record (with its args and
+        # exc_info) is formatted there instead of here
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggingSetup:
+    def __init__(
+        self, handler: DroppingQueueHandler, rate_limit: RateLimitFilter
+    ) -> None:
+        self.handler = handler
+        self.rate_limit = rate_limit
+        self.listener = None
+
+    def get_stats(self):
+        return {
+            "queued": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "suppressed": self.rate_limit.suppressed,
+        }
+
+    def stop(self):
+        # Writes out whatever is still queued, then the number of records
+        # dropped, straight to the handlers since the queue is gone
+        if self.listener is None:
+            return
+        self.listener.stop()
+        if self.handler.dropped:
+            record = logging.makeLogRecord(
+                {
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"Dropped {self.handler.dropped} log records",
+                }
+            )
+            for handler in self.listener.handlers:
+                handler.handle(record)
+        self.listener = None
+
+
+_logging_setup = None
+
+
+def setup_logging(level=LOG_LEVEL, log_file=LOG_FILE, console: bool = True):
+    # Routes every record through a queue to a background thread that formats
+    # and writes it to log_file (None for none) and the console, so a slow
+    # disk or terminal never holds up the serial or processing threads
+    global _logging_setup
+    if _logging_setup is not None:
+        _logging_setup.stop()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = []
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))  # Log to a file
+    if console:
+        handlers.append(logging.StreamHandler())  # Log to the console
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    rate_limit = RateLimitFilter()
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(rate_limit)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _logging_setup = LoggingSetup(queue_handler, rate_limit)
+    _logging_setup.listener = logging.handlers.QueueListener(
+        queue_handler.queue, *handlers, respect_handler_level=True
+    )
+    _logging_setup.listener.start()
+    atexit.register(_logging_setup.stop)
+    return _logging_setup
+
+
+def get_logging_stats():
+    if _logging_setup is None:
+        return {}
+    return _logging_setup.get_stats()
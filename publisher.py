@@ -0,0 +1,267 @@
+import select
+import socket
+import struct
+import sys
+import threading
+import numpy as np
+from config import ConfigSingleton
+from data_api import DataType
+from frame_queue import FrameQueue, OverflowPolicy
+from recording import SAMPLE_DTYPES
+
+from datetime import datetime
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_HOST = ConfigSingleton().get_config()["PUBLISH_HOST"]
+PUBLISH_PORT = ConfigSingleton().get_config()["PUBLISH_PORT"]
+PUBLISH_BUFFER_FRAMES = ConfigSingleton().get_config()["PUBLISH_BUFFER_FRAMES"]
+
+# Stream layout: every message is one fixed-size little-endian header
+# followed by count samples in the recording sample dtype of data_type.
+# sequence counts published messages, a gap means the subscriber's buffer
+# overflowed and frames were dropped.
+MESSAGE_MAGIC = b"SNSF"
+MESSAGE_VERSION = 1
+MESSAGE_HEADER = struct.Struct("<4sBBBxQqddI")
+
+
+class FrameMessage:
+    def __init__(
+        self,
+        sequence: int,
+        data_mode: int,
+        data_type: DataType,
+        index: int,
+        timestamp: float,
+        sample_rate: float,
+        values: np.ndarray,
+    ) -> None:
+        self.sequence = sequence
+        self.data_mode = data_mode
+        self.data_type = data_type
+        # Sample index on the channel's timebase and POSIX time of values[0]
+        self.index = index
+        self.timestamp = timestamp
+        self.sample_rate = sample_rate
+        self.values = values
+
+    def pack(self) -> bytes:
+        values = np.asarray(self.values).astype(
+            SAMPLE_DTYPES[self.data_type], copy=False
+        )
+        return (
+            MESSAGE_HEADER.pack(
+                MESSAGE_MAGIC,
+                MESSAGE_VERSION,
+                self.data_mode,
+                self.data_type.value,
+                self.sequence,
+                self.index,
+                self.timestamp,
+                self.sample_rate,
+                len(values),
+            )
+            + values.tobytes()
+        )
+
+    def times(self) -> np.ndarray:
+        # POSIX timestamps of every sample
+        return self.timestamp + np.arange(len(self.values)) / self.sample_rate
+
+
+class Subscriber:
+    # One connected client, messages are queued by publish() and sent by
+    # the subscriber's own thread so a slow client only loses its own frames
+    def __init__(self, connection: socket.socket, address, buffer_frames: int):
+        self.connection = connection
+        self.address = address
+        self.queue = FrameQueue(
+            buffer_frames, OverflowPolicy.DROP_OLDEST, f"subscriber {address}"
+        )
+        self.thread = threading.Thread(target=self.run, name=f"subscriber {address}")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                messages = self.queue.get_all()
+                if not messages:
+                    # Only returned empty once closed
+                    break
+                self.connection.sendall(b"".join(messages))
+        except OSError as e:
+            logger.info(f"Subscriber {self.address} disconnected: {e}")
+        finally:
+            self.queue.close()
+            self.connection.close()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def close(self):
+        self.queue.close()
+        self.thread.join(timeout=5)
+
+
+class FramePublisher:
+    # Publishes decoded frames to every client connected to a local TCP
+    # port. publish() never blocks on a client.
+    def __init__(
+        self,
+        host: str = PUBLISH_HOST,
+        port: int = PUBLISH_PORT,
+        buffer_frames: int = PUBLISH_BUFFER_FRAMES,
+    ) -> None:
+        self.buffer_frames = buffer_frames
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.sequence = 0
+        self.stop_flag = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="publisher")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info(f"Publishing frames on {self.address[0]}:{self.address[1]}")
+
+    def run(self):
+        while not self.stop_flag.is_set():
+            readable, _, _ = select.select([self.server], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            logger.info(f"Subscriber {address} connected")
+            with self.lock:
+                self.subscribers.append(
+                    Subscriber(connection, address, self.buffer_frames)
+                )
+
+    def publish(
+        self,
+        data_mode: int,
+        data_type: DataType,
+        index: int,
+        timestamp: float,
+        sample_rate: float,
+        values,
+    ):
+        with self.lock:
+            self.subscribers = [
+                subscriber for subscriber in self.subscribers if subscriber.is_alive()
+            ]
+            if not self.subscribers:
+                return
+            self.sequence += 1
+            message = FrameMessage(
+                self.sequence,
+                data_mode,
+                data_type,
+                index,
+                timestamp,
+                sample_rate,
+                values,
+            ).pack()
+            for subscriber in self.subscribers:
+                subscriber.queue.put(message)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "messages": self.sequence,
+                "subscribers": {
+                    f"{subscriber.address[0]}:{subscriber.address[1]}": (
+                        subscriber.queue.get_stats()
+                    )
+                    for subscriber in self.subscribers
+                    if subscriber.is_alive()
+                },
+            }
+
+    def stop(self):
+        self.stop_flag.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+        self.server.close()
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+
+
+def start_publisher():
+    # Returns None when publishing is disabled (PUBLISH_PORT 0) or the port
+    # is taken, acquisition runs the same either way
+    if not PUBLISH_PORT:
+        return None
+    try:
+        return FramePublisher()
+    except OSError as e:
+        logger.error(f"Can't publish frames on {PUBLISH_HOST}:{PUBLISH_PORT}: {e}")
+        return None
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Publisher closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def subscribe(host: str, port: int):
+    # Yields FrameMessage objects from a FramePublisher until it disconnects
+    with socket.create_connection((host, port)) as connection:
+        while True:
+            try:
+                header = receive_exactly(connection, MESSAGE_HEADER.size)
+            except EOFError:
+                return
+            (
+                magic,
+                version,
+                data_mode,
+                data_type,
+                sequence,
+                index,
+                timestamp,
+                sample_rate,
+                count,
+            ) = MESSAGE_HEADER.unpack(header)
+            if magic != MESSAGE_MAGIC:
+                raise ValueError("Not a sensor frame stream")
+            if version != MESSAGE_VERSION:
+                raise ValueError(f"Frame stream version {version} not supported!")
+            data_type = DataType(data_type)
+            dtype = SAMPLE_DTYPES[data_type]
+            values = np.frombuffer(
+                receive_exactly(connection, count * dtype.itemsize), dtype=dtype
+            )
+            yield FrameMessage(
+                sequence, data_mode, data_type, index, timestamp, sample_rate, values
+            )
+
+
+if __name__ == "__main__":
+    # python publisher.py [port] prints a line per frame received
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PUBLISH_PORT
+    last_sequence = None
+    for message in subscribe(PUBLISH_HOST, port):
+        if last_sequence is not None and message.sequence != last_sequence + 1:
+            print(f"Dropped {message.sequence - last_sequence - 1} frames")
+        last_sequence = message.sequence
+        print(
+            f"#{message.sequence} mode {message.data_mode} "
+            f"{message.data_type.name} sample {message.index} at "
+            f"{datetime.fromtimestamp(message.timestamp)}: "
+            f"{len(message.values)} samples, mean {message.values.mean():.4g}"
+        )
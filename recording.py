@@ -0,0 +1,231 @@
+import os
+import queue
+import struct
+import sys
+import threading
+import numpy as np
+from config import ConfigSingleton
+from data_api import DataType
+
+from datetime import datetime
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+RECORDING_QUEUE_SIZE = ConfigSingleton().get_config()["RECORDING_QUEUE_SIZE"]
+
+# File layout: one fixed-size little-endian header followed by fixed-size
+# frame records, each an int64 sample index and samples_per_frame values
+RECORDING_MAGIC = b"SENSREC1"
+RECORDING_VERSION = 1
+HEADER_FORMAT = "<8sHBBddII"
+HEADER_SIZE = 64
+
+SAMPLE_DTYPES = {
+    DataType.UINT32: np.dtype("<u4"),
+    DataType.FLOAT32: np.dtype("<f4"),
+}
+
+
+class RecordingHeader:
+    def __init__(
+        self,
+        data_mode: int,
+        data_type: DataType,
+        sample_rate: float,
+        start_time: float,
+        samples_per_frame: int,
+    ) -> None:
+        self.data_mode = data_mode
+        self.data_type = data_type
+        self.sample_rate = sample_rate
+        self.start_time = start_time
+        self.samples_per_frame = samples_per_frame
+
+    def record_dtype(self) -> np.dtype:
+        return np.dtype(
+            [
+                ("index", "<i8"),
+                (
+                    "values",
+                    SAMPLE_DTYPES[self.data_type],
+                    (self.samples_per_frame,),
+                ),
+            ]
+        )
+
+    def pack(self) -> bytes:
+        return struct.pack(
+            HEADER_FORMAT,
+            RECORDING_MAGIC,
+            RECORDING_VERSION,
+            self.data_mode,
+            self.data_type.value,
+            self.sample_rate,
+            self.start_time,
+            self.samples_per_frame,
+            HEADER_SIZE,
+        ).ljust(HEADER_SIZE, b"\0")
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        (
+            magic,
+            version,
+            data_mode,
+            data_type,
+            sample_rate,
+            start_time,
+            samples_per_frame,
+            header_size,
+        ) = struct.unpack_from(HEADER_FORMAT, data)
+        if magic != RECORDING_MAGIC or header_size != HEADER_SIZE:
+            raise ValueError("Not a sensor recording")
+        if version != RECORDING_VERSION:
+            raise ValueError(f"Recording version {version} not supported!")
+        return cls(
+            data_mode, DataType(data_type), sample_rate, start_time, samples_per_frame
+        )
+
+
+class Recorder:
+    # Appends frames to a timestamped recording file from a background writer
+    # thread, so the processing thread only pays for a queue put. Frames that
+    # don't fit in the queue, or arrive after a write failed, are dropped and
+    # counted.
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        header: RecordingHeader,
+        queue_size: int = RECORDING_QUEUE_SIZE,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.header = header
+        self.record_dtype = header.record_dtype()
+        stem = os.path.join(
+            directory,
+            f"{name}_{datetime.now():%Y%m%d_%H%M%S}",
+        )
+        self.path = f"{stem}.rec"
+        suffix = 1
+        while os.path.exists(self.path):
+            self.path = f"{stem}_{suffix}.rec"
+            suffix += 1
+        self.file = open(self.path, "wb")
+        self.file.write(header.pack())
+        self.queue = queue.Queue(queue_size)
+        self.frame_count = 0
+        self.dropped = 0
+        self.failed = False
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+        logger.info(f"Recording to {self.path}")
+
+    def write(self, index: int, values):
+        if self.failed:
+            self.dropped += 1
+            return
+        record = np.empty(1, dtype=self.record_dtype)
+        record["index"] = index
+        record["values"] = values
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        # Keeps draining the queue after a failed write so close() never
+        # blocks on a full queue
+        running = True
+        while running:
+            records = [self.queue.get()]
+            # Drain everything pending and write it in one call
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if records[-1] is None:
+                running = False
+            records = [record for record in records if record is not None]
+            if not records:
+                continue
+            if self.failed:
+                self.dropped += len(records)
+                continue
+            try:
+                self.file.write(np.concatenate(records).tobytes())
+                self.file.flush()
+                self.frame_count += len(records)
+            except OSError as e:
+                logger.error(f"Recording to {self.path} failed: {e}")
+                self.failed = True
+                self.dropped += len(records)
+
+    def get_stats(self):
+        return {
+            "path": self.path,
+            "frames": self.frame_count,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        if not self.file:
+            return
+        try:
+            self.file.close()
+        except OSError as e:
+            logger.error(f"Recording to {self.path} failed: {e}")
+            self.failed = True
+        self.file = None
+        if self.failed:
+            logger.error(
+                f"Recording to {self.path} failed after {self.frame_count} "
+                f"frames, {self.dropped} dropped"
+            )
+        elif self.dropped:
+            logger.warning(
+                f"Recorded {self.frame_count} frames to {self.path}, "
+                f"{self.dropped} dropped"
+            )
+        else:
+            logger.info(f"Recorded {self.frame_count} frames to {self.path}")
+
+
+def read_recording(path: str):
+    # Returns the header and a read-only memmap of the frame records, a
+    # partially written last record is ignored
+    with open(path, "rb") as file:
+        header = RecordingHeader.unpack(file.read(HEADER_SIZE))
+    record_dtype = header.record_dtype()
+    frame_count = (os.path.getsize(path) - HEADER_SIZE) // record_dtype.itemsize
+    if frame_count == 0:
+        return header, np.empty(0, dtype=record_dtype)
+    frames = np.memmap(
+        path, dtype=record_dtype, mode="r", offset=HEADER_SIZE, shape=(frame_count,)
+    )
+    return header, frames
+
+
+def recording_times(header: RecordingHeader, frames) -> np.ndarray:
+    # POSIX timestamps of every sample, shaped like frames["values"]
+    index = frames["index"][:, None] + np.arange(header.samples_per_frame)
+    return header.start_time + index / header.sample_rate
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        header, frames = read_recording(path)
+        print(
+            f"{path}: mode {header.data_mode}, data type {header.data_type.name}, "
+            f"{header.sample_rate} Hz, started "
+            f"{datetime.fromtimestamp(header.start_time)}, "
+            f"{len(frames)} frames of {header.samples_per_frame} samples"
+        )
@@ -0,0 +1,88 @@
+import threading
+import time
+from bus import Bus, TransactionClass
+from data_api import DataType, decode_data, read_modbus_block
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Modbus limit for one read holding registers request
+MAX_BLOCK_REGISTERS = 125
+
+REGISTER_COUNTS = {DataType.UINT16: 1, DataType.UINT32: 2, DataType.FLOAT32: 2}
+
+
+def group_registers(addresses, max_gap=0, max_count=MAX_BLOCK_REGISTERS):
+    # Groups (address, count) spans into the fewest contiguous (start, count)
+    # blocks, reading up to max_gap unused registers to join two spans
+    blocks = []
+    for address, count in sorted(set(addresses)):
+        if blocks:
+            start, block_count = blocks[-1]
+            end = max(start + block_count, address + count)
+            if address <= start + block_count + max_gap and end - start <= max_count:
+                blocks[-1] = (start, end - start)
+                continue
+        blocks.append((address, count))
+    return blocks
+
+
+class RegisterPoller:
+    # Serves named holding register values from a shared cache, refreshed
+    # with one read per contiguous block once the cache is older than ttl
+    def __init__(
+        self,
+        bus: Bus,
+        registers: dict,
+        ttl: float = 1.0,
+        max_gap: int = 0,
+    ) -> None:
+        # registers maps a name to (address, DataType)
+        self.bus = bus
+        self.registers = registers
+        self.ttl = ttl
+        self.blocks = group_registers(
+            [
+                (address, REGISTER_COUNTS[data_type])
+                for address, data_type in registers.values()
+            ],
+            max_gap,
+        )
+        self.lock = threading.Lock()
+        self.values = {}
+        self.updated = None
+        self.read_count = 0
+        logger.info(
+            f"Polling {len(registers)} registers in {len(self.blocks)} block(s): "
+            f"{self.blocks}"
+        )
+
+    def refresh(self):
+        values = {}
+        for start, count in self.blocks:
+            block = self.bus.call(
+                lambda client: read_modbus_block(client, start, count),
+                TransactionClass.POLL,
+            )
+            self.read_count += 1
+            if block is None:
+                continue
+            for name, (address, data_type) in self.registers.items():
+                if start <= address < start + count:
+                    offset = address - start
+                    values[name] = decode_data(
+                        block[offset : offset + REGISTER_COUNTS[data_type]], data_type
+                    )
+        self.values = values
+        self.updated = time.monotonic()
+
+    def get_values(self):
+        # Values of every register, None for registers whose block failed
+        with self.lock:
+            if self.updated is None or time.monotonic() - self.updated >= self.ttl:
+                self.refresh()
+            return {name: self.values.get(name) for name in self.registers}
+
+    def get(self, name):
+        return self.get_values()[name]
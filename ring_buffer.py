@@ -0,0 +1,60 @@
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    def __init__(self, capacity: int, dtype=np.float64, shape: tuple = ()) -> None:
+        assert capacity > 0, "RingBuffer capacity must be positive"
+        self.capacity = capacity
+        # Every sample is stored twice, at i and i + capacity, so the latest
+        # samples are always one contiguous slice of the backing arrays. A
+        # sample is a scalar or, with shape, a row of that shape.
+        self.times = np.zeros(2 * capacity, dtype=np.float64)
+        self.values = np.zeros((2 * capacity, *shape), dtype=dtype)
+        self.head = 0
+        self.size = 0
+        # Total number of samples ever appended, doubles as a data version
+        self.count = 0
+
+    def __len__(self):
+        return self.size
+
+    def _write(self, column: np.ndarray, data: np.ndarray):
+        end = self.head + len(data)
+        if end <= self.capacity:
+            column[self.head : end] = data
+            column[self.head + self.capacity : end + self.capacity] = data
+        else:
+            first = self.capacity - self.head
+            column[self.head : self.capacity] = data[:first]
+            column[self.head + self.capacity :] = data[:first]
+            column[: end - self.capacity] = data[first:]
+            column[self.capacity : end] = data[first:]
+
+    def extend(self, times, values):
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=self.values.dtype)
+        assert len(times) == len(values), "times and values length mismatch"
+        appended = len(values)
+        if appended == 0:
+            return
+        if appended > self.capacity:
+            times = times[-self.capacity :]
+            values = values[-self.capacity :]
+        self._write(self.times, times)
+        self._write(self.values, values)
+        self.head = (self.head + len(values)) % self.capacity
+        self.size = min(self.size + len(values), self.capacity)
+        self.count += appended
+
+    def latest(self, n=None):
+        n = self.size if n is None else min(n, self.size)
+        end = self.head + self.capacity
+        times = self.times[end - n : end]
+        values = self.values[end - n : end]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        return times, values
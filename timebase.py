@@ -0,0 +1,49 @@
+import time
+import numpy as np
+
+from datetime import datetime
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Timebase:
+    # Sample times are an int64 sample index at sample_rate counted from a
+    # single wall clock start, datetimes are only built for labels
+    def __init__(self, sample_rate: float) -> None:
+        self.sample_rate = sample_rate
+        self.start = None
+        self.monotonic_start = None
+        self.index = 0
+
+    def start_at(self, monotonic_time: float):
+        # Anchor sample 0 at a time.monotonic() instant
+        self.monotonic_start = monotonic_time
+        self.start = time.time() - (time.monotonic() - monotonic_time)
+
+    def next_frame(self, sample_count: int) -> int:
+        if self.start is None:
+            self.start_at(time.monotonic())
+        index = self.index
+        self.index += sample_count
+        return index
+
+    def frame_at(self, monotonic_time: float, sample_count: int) -> int:
+        # Index of a frame read at a time.monotonic() deadline, so skipped
+        # deadlines leave a gap instead of shifting later samples
+        if self.start is None:
+            self.start_at(monotonic_time)
+        index = int(round((monotonic_time - self.monotonic_start) * self.sample_rate))
+        self.index = index + sample_count
+        return index
+
+    def times(self, index: int, sample_count: int, step: int = 1) -> np.ndarray:
+        # Seconds since start for samples index, index + step, ...
+        return (index + np.arange(0, sample_count, step, dtype=np.int64)) / float(
+            self.sample_rate
+        )
+
+    def to_datetime(self, seconds: float) -> datetime:
+        start = time.time() if self.start is None else self.start
+        return datetime.fromtimestamp(start + seconds)